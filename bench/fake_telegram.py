@@ -0,0 +1,129 @@
+"""Локальная заглушка Telegram Bot API и генератор синтетических обновлений.
+
+Бот направляется на заглушку через TELEGRAM_API_BASE_URL=http://127.0.0.1:<порт>/bot,
+а заглушка запоминает, когда и какому чату бот ответил.
+"""
+import json
+import time
+import asyncio
+import itertools
+from collections import defaultdict
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class FakeBotAPI:
+    """Отвечает на методы Bot API правдоподобными объектами и ведёт журнал вызовов"""
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.replies = defaultdict(list)  # chat_id -> [(время, текст)] для sendMessage
+        # chat_id -> [(время, метод, текст)] для всего, что видит пользователь
+        self.events = defaultdict(list)
+        self._changed = defaultdict(asyncio.Event)
+        self._message_ids = itertools.count(1_000_000)
+        self._updates = []  # очередь для getUpdates (режим long polling)
+        self._updates_changed = asyncio.Event()
+
+    def push_update(self, update: dict):
+        """Кладёт обновление в очередь, которую бот заберёт через getUpdates"""
+        self._updates.append(update)
+        self._updates_changed.set()
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        # Как и Telegram, offset подтверждает все обновления до него
+        self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates:
+            self._updates_changed.clear()
+            try:
+                await asyncio.wait_for(self._updates_changed.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get('limit') or 100)]
+
+    async def wait_for(self, chat_id, predicate, start=0, timeout=60):
+        """Ждёт событие чата с индексом >= start, для которого predicate(метод, текст) истинно.
+
+        Возвращает (индекс, время события) или None по таймауту.
+        """
+        deadline = time.perf_counter() + timeout
+        index = start
+        while True:
+            events = self.events[chat_id]
+            while index < len(events):
+                at, method, text = events[index]
+                if predicate(method, text):
+                    return index, at
+                index += 1
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            changed = self._changed[chat_id]
+            changed.clear()
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    async def _params(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] += 1
+        chat_id = params.get('chat_id')
+        if method == 'sendMessage':
+            self.replies[int(chat_id)].append((time.perf_counter(), params.get('text')))
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            self.events[int(chat_id)].append((time.perf_counter(), method, params.get('text') or ''))
+            self._changed[int(chat_id)].set()
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getUpdates':
+            result = await self._get_updates(params)
+        elif method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            message_id = int(params.get('message_id') or next(self._message_ids))
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id), 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', '')
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def make_text_update(user_id: int, text: str) -> dict:
+    """Синтетическое обновление: личное сообщение пользователя user_id"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+        'from': user,
+        'text': text
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def dumps(update: dict) -> bytes:
+    return json.dumps(update, ensure_ascii=False).encode('utf-8')
@@ -0,0 +1,182 @@
+"""Нагрузочный стенд: бот целиком в одном процессе против локальных заглушек.
+
+Поднимает заглушки Bot API, OpenRouter и PostgREST, подменяет базу
+(в памяти или настоящая по DATABASE_URL со счётчиком обращений) и прогоняет
+сценарий «N пользователей × M сообщений» через Application.update_queue.
+Каждый пользователь отправляет следующее сообщение, только получив ответ
+на предыдущее.
+
+    python bench/load_test.py --users 200 --messages 5 --scenario chat
+    python bench/load_test.py --users 500 --messages 10 --scenario mixed --llm-latency 1.5 --llm-error-rate 0.02
+    python bench/load_test.py --db postgres --users 50   # DATABASE_URL — одноразовая база!
+
+Сценарии: chat — только вопросы к модели, menu — только кнопки меню,
+mixed — вопросы вперемешку с кнопками и выдачей доступа к сайту.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import functools
+from collections import defaultdict
+from aiohttp import web
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_telegram import FakeBotAPI, make_text_update
+from mock_openrouter import MockOpenRouter
+from mock_postgrest import MockPostgREST
+from webhook_harness import percentile
+
+SCENARIOS = {
+    'chat': ['ask'],
+    'menu': ['help', 'continue', 'dialogs'],
+    'mixed': ['ask', 'dialogs', 'ask', 'site', 'ask', 'help']
+}
+MENU_TEXTS = {
+    'help': '❓ Помощь',
+    'continue': '💬 Продолжить диалог',
+    'dialogs': '👀 Мои диалоги',
+    'site': '🌐 Доступ к сайту'
+}
+
+
+async def start_server(app, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+def configure_environment(args):
+    """Переменные окружения читаются модулями бота при импорте, поэтому задаются до него"""
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:bench',
+        'TELEGRAM_API_BASE_URL': f'http://127.0.0.1:{args.api_port}/bot',
+        'OPENROUTER_URL': f'http://127.0.0.1:{args.llm_port}/api/v1/chat/completions',
+        'OPEN_ROUTER_API_KEY': 'bench',
+        'SUPABASE_URL': f'http://127.0.0.1:{args.postgrest_port}',
+        'SUPABASE_KEY': 'bench',
+        'STREAM_RESPONSES': '1' if args.stream else '0',
+        'STREAM_EDIT_INTERVAL': str(args.edit_interval)
+    })
+
+    import db as db_module
+    from memory_db import MemoryDatabase, CountingDatabase
+    if args.db == 'memory':
+        db_module.Database = functools.partial(MemoryDatabase, latency=args.db_latency)
+    else:
+        db_module.Database = CountingDatabase
+
+
+def is_done(kind, seq):
+    if kind != 'ask':
+        return lambda method, text: method == 'sendMessage'
+    marker = f"#{seq} ✅"
+    return lambda method, text: marker in text or (method == 'sendMessage' and text[:1] in ('❌', '⏳'))
+
+
+async def run(args):
+    api, llm, postgrest = FakeBotAPI(), MockOpenRouter(args.llm_latency, args.llm_tokens, args.token_interval,
+                                                      args.llm_error_rate, seed=1), MockPostgREST(args.postgrest_latency)
+    runners = [await start_server(api.app(), args.api_port),
+               await start_server(llm.app(), args.llm_port),
+               await start_server(postgrest.app(), args.postgrest_port)]
+
+    configure_environment(args)
+    import bot
+    from telegram import Update
+
+    app = bot.build_application()
+    await app.initialize()
+    await app.start()
+    round_trips_before = bot.db.sync.round_trips
+
+    kinds = SCENARIOS[args.scenario]
+    results = defaultdict(list)  # вид сообщения -> [(до первого ответа, до полного ответа, успех)]
+    timeouts = 0
+    seq = 0
+
+    async def user_session(user_id):
+        nonlocal timeouts, seq
+        for i in range(args.messages):
+            kind = kinds[i % len(kinds)]
+            seq += 1
+            number = seq
+            text = f"Вопрос #{number}: объясни тему {i}" if kind == 'ask' else MENU_TEXTS[kind]
+            start = len(api.events[user_id])
+            sent_at = time.perf_counter()
+            await app.update_queue.put(Update.de_json(make_text_update(user_id, text), app.bot))
+            first = await api.wait_for(user_id, lambda method, text: True, start, args.timeout)
+            done = await api.wait_for(user_id, is_done(kind, number), start, args.timeout)
+            if first is None or done is None:
+                timeouts += 1
+                continue
+            ok = kind != 'ask' or f"#{number} ✅" in api.events[user_id][done[0]][2]
+            results[kind].append((first[1] - sent_at, done[1] - sent_at, ok))
+            if args.think:
+                await asyncio.sleep(args.think)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(args.user_base + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    await bot.db.flush()
+    round_trips = bot.db.sync.round_trips - round_trips_before
+
+    total = args.users * args.messages
+    answered = sum(len(v) for v in results.values())
+    print(f"Сценарий {args.scenario}: {args.users} польз. × {args.messages} сообщ., база {args.db}, "
+          f"поток {'вкл' if args.stream else 'выкл'}")
+    print(f"Отвечено: {answered} из {total}, таймаутов: {timeouts}, за {elapsed:.1f} с")
+    print(f"Пропускная способность: {answered / elapsed:.1f} сообщ/с")
+    for kind, rows in sorted(results.items()):
+        firsts = [r[0] for r in rows]
+        fulls = [r[1] for r in rows]
+        failed = sum(1 for r in rows if not r[2])
+        print(f"  {kind:<9} n={len(rows):<6} ошибок={failed:<5} "
+              f"первый ответ p50/p95/p99 = {percentile(firsts, 0.5) * 1000:.0f}/"
+              f"{percentile(firsts, 0.95) * 1000:.0f}/{percentile(firsts, 0.99) * 1000:.0f} мс, "
+              f"полный ответ p50/p95/p99 = {percentile(fulls, 0.5) * 1000:.0f}/"
+              f"{percentile(fulls, 0.95) * 1000:.0f}/{percentile(fulls, 0.99) * 1000:.0f} мс")
+    print(f"Обращений к базе: {round_trips}, на сообщение: {round_trips / max(answered, 1):.2f}")
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+    print(f"OpenRouter: {llm.stats()}, PostgREST: {postgrest.requests} запросов")
+    print(f"Планировщик: {bot.llm_scheduler.stats()}")
+    print(f"Кэши базы: {bot.db.cache_stats()}")
+
+    await app.stop()
+    await app.shutdown()
+    await bot.on_shutdown(app)
+    for runner in runners:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='chat')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=5, help='сообщений на пользователя')
+    parser.add_argument('--think', type=float, default=0.0, help='пауза пользователя между сообщениями, с')
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=True, help='потоковые ответы')
+    parser.add_argument('--edit-interval', type=float, default=1.0, help='STREAM_EDIT_INTERVAL для бота, с')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='время до первого токена заглушки, с')
+    parser.add_argument('--llm-tokens', type=int, default=60, help='слов в ответе заглушки')
+    parser.add_argument('--token-interval', type=float, default=0.01, help='пауза между чанками потока, с')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='доля ответов заглушки с ошибкой 500')
+    parser.add_argument('--postgrest-latency', type=float, default=0.03)
+    parser.add_argument('--db', choices=['memory', 'postgres'], default='memory',
+                        help='база в памяти или настоящая по DATABASE_URL')
+    parser.add_argument('--db-latency', type=float, default=0.002, help='задержка запроса к базе в памяти, с')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--llm-port', type=int, default=8082)
+    parser.add_argument('--postgrest-port', type=int, default=8083)
+    parser.add_argument('--user-base', type=int, default=10_000_000, help='первый синтетический user_id')
+    parser.add_argument('--timeout', type=float, default=120, help='сколько ждать ответа на сообщение, с')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
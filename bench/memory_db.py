@@ -0,0 +1,178 @@
+"""Подмены db.Database для стендов: счётчик обращений к настоящей базе и база в памяти.
+
+Обе считают обращения к базе: одно взятие соединения из пула — один
+запрос-ответ с сервером (пачка из save_conversations тоже идёт одной транзакцией).
+"""
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import TTLCache
+from db import Database, MAX_DIALOGS, USER_CACHE_SIZE, USER_CACHE_TTL, DB_POOL_MAX, format_dialog_preview
+
+
+class CountingDatabase(Database):
+    """Настоящая база (DATABASE_URL), но с подсчётом обращений"""
+    def __init__(self):
+        self.round_trips = 0
+        self._counter_lock = threading.Lock()
+        super().__init__()
+
+    @contextmanager
+    def get_connection(self):
+        with self._counter_lock:
+            self.round_trips += 1
+        with super().get_connection() as conn:
+            yield conn
+
+
+class MemoryDatabase(Database):
+    """База в памяти процесса с тем же API, что и Database.
+
+    Логика кэшей пользователей и сессий наследуется от Database, подменяются
+    только методы, которые ходят в PostgreSQL. latency имитирует время
+    запроса-ответа до сервера базы.
+    """
+    def __init__(self, latency=0.002, maxconn=DB_POOL_MAX):
+        self.latency = latency
+        self.round_trips = 0
+        self.maxconn = maxconn
+        self.pool = None
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.session_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._next_id = 1
+        self.users = {}
+        self.sessions = {}
+        self.conversations = {}  # (user_id, dialog_id) -> [(id, role, content, mode)]
+        self.dialogs = {}  # (user_id, dialog_id) -> {'preview', 'mode', 'count', 'summary', 'upto_id'}
+
+    @contextmanager
+    def _round_trip(self):
+        # Как и у настоящего пула: не больше maxconn запросов одновременно
+        with self._slots:
+            with self._lock:
+                self.round_trips += 1
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                yield
+
+    def init_db(self):
+        return 0
+
+    def close(self):
+        pass
+
+    def _upsert_user(self, user_id, username, first_name):
+        with self._round_trip():
+            self.users[user_id] = (username, first_name)
+        self.user_cache.set(user_id, (username, first_name))
+
+    def _load_user_session(self, user_id):
+        with self._round_trip():
+            session = self.sessions.get(user_id, ('free', 1))
+        self.session_cache.set(user_id, session)
+        return session
+
+    def set_user_session(self, user_id, mode, dialog_id=1):
+        with self._round_trip():
+            self.sessions[user_id] = (mode, dialog_id)
+        self.session_cache.set(user_id, (mode, dialog_id))
+
+    def _insert(self, user_id, role, content, mode, dialog_id):
+        key = (user_id, dialog_id)
+        self.conversations.setdefault(key, []).append((self._next_id, role, content, mode))
+        self._next_id += 1
+        dialog = self.dialogs.setdefault(key, {'preview': None, 'mode': mode, 'count': 0, 'summary': None, 'upto_id': 0})
+        if role == 'user':
+            dialog['preview'], dialog['mode'] = content[:200], mode
+        dialog['count'] += 1
+
+    def save_conversation(self, user_id, role, content, mode, dialog_id=1):
+        with self._round_trip():
+            self._insert(user_id, role, content, mode, dialog_id)
+
+    def save_conversations(self, rows):
+        with self._round_trip():
+            for row in rows:
+                self._insert(*row)
+
+    def get_conversation_history(self, user_id, dialog_id=1, limit=6, before_id=None):
+        with self._round_trip():
+            rows = [(role, content, mode) for id_, role, content, mode in self.conversations.get((user_id, dialog_id), [])
+                    if before_id is None or id_ < before_id]
+        return rows[-limit:]
+
+    def get_history_window(self, user_id, dialog_id=1, after_id=0, before_id=None, limit=50, newest_first=True):
+        with self._round_trip():
+            rows = [(id_, role, content) for id_, role, content, _ in self.conversations.get((user_id, dialog_id), [])
+                    if id_ > after_id and (before_id is None or id_ < before_id)]
+        if newest_first:
+            rows.reverse()
+        return rows[:limit]
+
+    def get_dialog_summary(self, user_id, dialog_id=1):
+        with self._round_trip():
+            dialog = self.dialogs.get((user_id, dialog_id))
+        return (dialog['summary'], dialog['upto_id']) if dialog else (None, 0)
+
+    def save_dialog_summary(self, user_id, dialog_id, summary, upto_id):
+        with self._round_trip():
+            dialog = self.dialogs.get((user_id, dialog_id))
+            if dialog and dialog['upto_id'] < upto_id:
+                dialog['summary'], dialog['upto_id'] = summary, upto_id
+
+    def clear_conversation_history(self, user_id, dialog_id=1):
+        with self._round_trip():
+            self.conversations.pop((user_id, dialog_id), None)
+            self.dialogs.pop((user_id, dialog_id), None)
+
+    def get_all_dialogs_summary(self, user_id):
+        summaries = {did: None for did in range(1, MAX_DIALOGS + 1)}
+        with self._round_trip():
+            for did in summaries:
+                dialog = self.dialogs.get((user_id, did))
+                if dialog and dialog['preview'] is not None:
+                    summaries[did] = format_dialog_preview(dialog['preview'], dialog['mode'])
+        return summaries
+
+    def start_new_dialog(self, user_id, mode='general'):
+        with self._round_trip():
+            busy = {did for (uid, did), dialog in self.dialogs.items() if uid == user_id and dialog['preview'] is not None}
+            dialog_id = next((i for i in range(1, MAX_DIALOGS + 1) if i not in busy), None)
+            if dialog_id is None:
+                return None
+            self.conversations.pop((user_id, dialog_id), None)
+            self.dialogs.pop((user_id, dialog_id), None)
+            self.sessions[user_id] = (mode, dialog_id)
+        self.session_cache.set(user_id, (mode, dialog_id))
+        return dialog_id
+
+    def run_retention(self):
+        return {}
+
+    def search_conversations(self, user_id, query, limit=5, cursor=None):
+        # Без морфологии: совпадение по подстроке любого слова запроса, ранг — число совпавших слов
+        words = [w for w in query.lower().split() if len(w) > 2]
+        with self._round_trip():
+            hits = []
+            for (uid, dialog_id), rows in self.conversations.items():
+                if uid != user_id:
+                    continue
+                for id_, role, content, _ in rows:
+                    rank = float(sum(w in content.lower() for w in words))
+                    if rank:
+                        hits.append({'id': id_, 'dialog_id': dialog_id, 'role': role, 'created_at': None,
+                                     'rank': rank, 'snippet': content[:200]})
+        hits.sort(key=lambda h: (h['rank'], h['id']), reverse=True)
+        if cursor:
+            after_rank, after_id = cursor.split(':')
+            hits = [h for h in hits if (h['rank'], h['id']) < (float(after_rank), int(after_id))]
+        next_cursor = f"{hits[limit - 1]['rank']!r}:{hits[limit - 1]['id']}" if len(hits) > limit else None
+        return hits[:limit], next_cursor
@@ -0,0 +1,110 @@
+"""Заглушка OpenRouter chat/completions с настраиваемой задержкой, потоком и ошибками.
+
+Бот направляется на неё через OPENROUTER_URL=http://127.0.0.1:<порт>/api/v1/chat/completions.
+Ответ заканчивается меткой «#<номер> ✅», где номер взят из последнего
+сообщения пользователя, — по ней стенд узнаёт, на какой вопрос пришёл ответ.
+
+Запуск отдельно: python bench/mock_openrouter.py --port 8082 --latency 0.8
+"""
+import re
+import json
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+ANSWER_WORDS = ('Вот', 'подробный', 'ответ', 'на', 'ваш', 'вопрос', 'с', 'примерами', 'и', 'пояснениями.')
+
+
+def answer_marker(text: str) -> str:
+    match = re.search(r'#(\d+)', text or '')
+    return f"#{match.group(1)} ✅" if match else "✅"
+
+
+class MockOpenRouter:
+    """latency — время до первого токена, tokens — длина ответа в словах,
+    token_interval — пауза между чанками потока, error_rate — доля ответов 500"""
+    def __init__(self, latency=0.5, tokens=60, token_interval=0.01, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.streamed = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _answer(self, messages):
+        question = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+        words = [ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(self.tokens)]
+        return words + [answer_marker(question)]
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return web.json_response({'error': {'message': 'mock upstream error', 'code': 500}}, status=500)
+            words = self._answer(body.get('messages', []))
+            usage = {
+                'prompt_tokens': sum(len(m.get('content', '')) // 4 for m in body.get('messages', [])),
+                'completion_tokens': len(words)
+            }
+            if not body.get('stream'):
+                return web.json_response({
+                    'choices': [{'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+                    'usage': usage
+                })
+            self.streamed += 1
+            return await self._stream(request, words, usage)
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request, words, usage):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        await response.write(b': OPENROUTER PROCESSING\n\n')
+        for i, word in enumerate(words):
+            chunk = {'choices': [{'delta': {'content': word if i == 0 else ' ' + word}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'streamed': self.streamed,
+            'errors': self.errors,
+            'max_in_flight': self.max_in_flight
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/api/v1/chat/completions', self.handle)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.5, help='время до первого токена, с')
+    parser.add_argument('--tokens', type=int, default=60, help='слов в ответе')
+    parser.add_argument('--token-interval', type=float, default=0.01, help='пауза между чанками потока, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов с ошибкой 500')
+    args = parser.parse_args()
+    mock = MockOpenRouter(args.latency, args.tokens, args.token_interval, args.error_rate)
+    web.run_app(mock.app(), host='127.0.0.1', port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
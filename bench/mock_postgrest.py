@@ -0,0 +1,63 @@
+"""Заглушка PostgREST для таблицы website_users, которой пользуется supabase_http.
+
+Бот направляется на неё через SUPABASE_URL=http://127.0.0.1:<порт> (ключ любой).
+Поддерживаются запросы, которые делает SupabaseHTTPClient: выборка по
+telegram_id=eq.<id> и upsert с on_conflict=telegram_id.
+"""
+import asyncio
+import argparse
+from aiohttp import web
+
+
+class MockPostgREST:
+    def __init__(self, latency=0.03):
+        self.latency = latency
+        self.rows = {}  # telegram_id -> строка website_users
+        self.requests = 0
+        self._ids = 0
+
+    async def handle_get(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        condition = request.query.get('telegram_id', '')
+        if not condition.startswith('eq.'):
+            return web.json_response({'message': 'unsupported filter'}, status=400)
+        row = self.rows.get(int(condition[3:]))
+        if row is None:
+            return web.json_response([])
+        columns = request.query.get('select', '*')
+        if columns != '*':
+            row = {column: row.get(column) for column in columns.split(',')}
+        return web.json_response([row])
+
+    async def handle_post(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        data = await request.json()
+        telegram_id = int(data['telegram_id'])
+        row = self.rows.get(telegram_id)
+        if row is not None and request.query.get('on_conflict') != 'telegram_id':
+            return web.json_response({'message': 'duplicate key value'}, status=409)
+        if row is None:
+            self._ids += 1
+            row = self.rows[telegram_id] = {'id': self._ids}
+        row.update(data)
+        return web.json_response([row], status=201)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/rest/v1/website_users', self.handle_get)
+        app.router.add_post('/rest/v1/website_users', self.handle_post)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8083)
+    parser.add_argument('--latency', type=float, default=0.03, help='задержка ответа, с')
+    args = parser.parse_args()
+    web.run_app(MockPostgREST(args.latency).app(), host='127.0.0.1', port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
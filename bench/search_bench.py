@@ -0,0 +1,126 @@
+"""Стенд полнотекстового поиска: задержка Database.search_conversations на большой таблице.
+
+Заполняет conversations синтетическими сообщениями (по умолчанию миллион строк
+у десяти тысяч пользователей), затем ищет случайные слова у случайных
+пользователей и печатает перцентили задержки первой и второй страницы, а для
+сравнения — того же запроса через ILIKE.
+
+    DATABASE_URL=postgres://... python bench/search_bench.py --rows 1000000 --users 10000
+
+База должна быть одноразовой: стенд пишет в неё данные и не удаляет их.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database
+
+WORDS = [
+    'уравнение', 'дискриминант', 'интеграл', 'производная', 'функция', 'график', 'теорема', 'доказательство',
+    'реферат', 'курсовая', 'диплом', 'презентация', 'отчёт', 'письмо', 'резюме', 'собеседование',
+    'история', 'революция', 'империя', 'литература', 'роман', 'поэзия', 'сочинение', 'эссе',
+    'программа', 'алгоритм', 'массив', 'сортировка', 'рекурсия', 'база', 'запрос', 'таблица',
+    'химия', 'реакция', 'молекула', 'физика', 'скорость', 'ускорение', 'энергия', 'сила',
+    'биология', 'клетка', 'генетика', 'эволюция', 'экономика', 'рынок', 'спрос', 'предложение',
+    'перевод', 'грамматика', 'английский', 'немецкий', 'бюджет', 'проект', 'задача', 'решение',
+    'пример', 'объяснение', 'конспект', 'план', 'вопрос', 'ответ', 'совет', 'идея'
+]
+FILLER = ['как', 'почему', 'объясни', 'помоги', 'напиши', 'подробно', 'кратко', 'пожалуйста', 'нужно', 'сделать']
+
+
+def fill(db: Database, rows: int, users: int, batch: int):
+    """Генерирует сообщения на стороне сервера пачками по batch строк"""
+    vocabulary = WORDS + FILLER
+    done = 0
+    started = time.perf_counter()
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        while done < rows:
+            size = min(batch, rows - done)
+            cursor.execute('''
+                INSERT INTO conversations (user_id, role, content, mode, dialog_id, created_at)
+                SELECT 1 + (random() * (%(users)s - 1))::bigint,
+                       CASE WHEN random() < 0.5 THEN 'user' ELSE 'assistant' END,
+                       (SELECT string_agg((%(words)s::text[])[1 + (random() * (cardinality(%(words)s::text[]) - 1))::int], ' ')
+                        FROM generate_series(1, 10 + (g %% 40))),
+                       'general',
+                       1 + (g %% 5),
+                       LOCALTIMESTAMP - random() * interval '20 days'
+                FROM generate_series(1, %(size)s) AS g
+            ''', {'users': users, 'words': vocabulary, 'size': size})
+            conn.commit()
+            done += size
+            print(f"  {done}/{rows} строк, {time.perf_counter() - started:.0f} с", flush=True)
+        cursor.execute('ANALYZE conversations')
+        conn.commit()
+
+
+def percentiles(samples: list) -> str:
+    values = sorted(samples)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))] * 1000
+    return f"p50/p95/p99 = {pick(0.5):.1f}/{pick(0.95):.1f}/{pick(0.99):.1f} мс"
+
+
+def ilike(db: Database, user_id: int, word: str, limit: int):
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, dialog_id, role, left(content, 200) FROM conversations
+            WHERE user_id = %s AND content ILIKE %s
+            ORDER BY id DESC LIMIT %s
+        ''', (user_id, f'%{word}%', limit))
+        return cursor.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000, help="сколько сообщений добавить (0 — не заполнять)")
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--batch', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--page', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    db = Database()
+    db.init_db()
+    if args.rows:
+        print(f"Заполнение: {args.rows} сообщений у {args.users} пользователей")
+        fill(db, args.rows, args.users, args.batch)
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT count(*) FROM conversations')
+        total = cursor.fetchone()[0]
+
+    rnd = random.Random(args.seed)
+    first, second, naive = [], [], []
+    found = 0
+    for _ in range(args.queries):
+        user_id = rnd.randint(1, args.users)
+        query = ' '.join(rnd.sample(WORDS, rnd.choice((1, 1, 2))))
+        started = time.perf_counter()
+        results, cursor = db.search_conversations(user_id, query, args.page)
+        first.append(time.perf_counter() - started)
+        found += len(results)
+        if cursor:
+            started = time.perf_counter()
+            db.search_conversations(user_id, query, args.page, cursor)
+            second.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        ilike(db, user_id, query.split()[0], args.page)
+        naive.append(time.perf_counter() - started)
+
+    print(f"Строк в conversations: {total}, запросов: {args.queries}, найдено в среднем {found / args.queries:.1f} на странице")
+    print(f"  поиск, первая страница  {percentiles(first)}")
+    if second:
+        print(f"  поиск, вторая страница  {percentiles(second)}")
+    print(f"  ILIKE по пользователю   {percentiles(naive)}")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Стенд для замера сквозной пропускной способности webhook-режима.
+
+Поднимает заглушку Bot API, ждёт, пока бот ответит на /healthz, шлёт
+синтетические обновления на webhook бота и ждёт, пока бот ответит в каждый
+чат. Бот при старте обращается к Bot API (getMe, setWebhook), поэтому
+сначала запускается стенд, а бот — следом, в другом терминале:
+
+    python bench/webhook_harness.py --users 100 --messages 5 --text "❓ Помощь"
+
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot WEBHOOK_URL=http://127.0.0.1:8443 \\
+    WEBHOOK_SECRET=bench python bot.py --mode webhook
+
+Кнопки меню отвечают без обращения к модели, поэтому по умолчанию
+измеряется сам путь Telegram -> бот -> Telegram.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import aiohttp
+from urllib.parse import urljoin
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeBotAPI, make_text_update, dumps
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def wait_for_bot(session, url: str, timeout: float) -> bool:
+    """Опрашивает /healthz бота, пока он не ответит 200 или не выйдет timeout"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return True
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    return False
+
+
+async def run(args):
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.api_port).start()
+    health_url = urljoin(args.webhook_url, '/healthz')
+    print(f"Заглушка Bot API на 127.0.0.1:{args.api_port}, жду бота на {health_url}...")
+
+    # (user_id, сколько ответов было до отправки, время отправки)
+    sent = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    headers = {SECRET_HEADER: args.secret, 'Content-Type': 'application/json'}
+    rejected = 0
+
+    async with aiohttp.ClientSession() as session:
+        if not await wait_for_bot(session, health_url, args.startup_timeout):
+            await runner.cleanup()
+            print(f"Бот не ответил на {health_url} за {args.startup_timeout:.0f} с")
+            return
+
+        async def post(user_id):
+            nonlocal rejected
+            async with semaphore:
+                before = len(api.replies[user_id])
+                started = time.perf_counter()
+                async with session.post(args.webhook_url, data=dumps(make_text_update(user_id, args.text)),
+                                        headers=headers) as response:
+                    if response.status != 200:
+                        rejected += 1
+                        return
+                sent.append((user_id, before, started))
+
+        started = time.perf_counter()
+        # Сообщения одного пользователя идут по очереди, пользователи — параллельно
+        async def user_session(user_id):
+            for _ in range(args.messages):
+                await post(user_id)
+
+        await asyncio.gather(*(user_session(args.user_base + i) for i in range(args.users)))
+        accepted_at = time.perf_counter()
+
+        deadline = time.perf_counter() + args.timeout
+        latencies = []
+        while time.perf_counter() < deadline:
+            latencies = []
+            counters = {}
+            for user_id, before, sent_at in sent:
+                index = counters.get(user_id, before)
+                replies = api.replies[user_id]
+                if index < len(replies):
+                    latencies.append(replies[index][0] - sent_at)
+                counters[user_id] = index + 1
+            if len(latencies) == len(sent):
+                break
+            await asyncio.sleep(0.05)
+        finished = time.perf_counter()
+
+    await runner.cleanup()
+
+    total = args.users * args.messages
+    print(f"Отправлено обновлений: {total}, отклонено webhook: {rejected}, с ответом: {len(latencies)}")
+    print(f"Приём webhook: {total / (accepted_at - started):.1f} обн/с")
+    print(f"Сквозная пропускная способность: {len(latencies) / (finished - started):.1f} обн/с")
+    print("Время до первого ответа, мс: "
+          f"p50={percentile(latencies, 0.5) * 1000:.1f} "
+          f"p95={percentile(latencies, 0.95) * 1000:.1f} "
+          f"p99={percentile(latencies, 0.99) * 1000:.1f}")
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--webhook-url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', 'bench'))
+    parser.add_argument('--api-port', type=int, default=8081, help='порт заглушки Bot API')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=5, help='сообщений на пользователя')
+    parser.add_argument('--text', default='❓ Помощь')
+    parser.add_argument('--concurrency', type=int, default=100, help='одновременных POST на webhook')
+    parser.add_argument('--user-base', type=int, default=10_000_000, help='первый синтетический user_id')
+    parser.add_argument('--timeout', type=float, default=60, help='сколько ждать ответов, с')
+    parser.add_argument('--startup-timeout', type=float, default=120, help='сколько ждать запуска бота, с')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
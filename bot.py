@@ -1,46 +1,103 @@
 import os
+import time
+# Отсчёт времени запуска, включая импорт telegram и остальных модулей
+STARTED_AT = time.monotonic()
 import asyncio
-import requests
+import argparse
+import logging
 import secrets
 import string
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from dotenv import load_dotenv
-from db import Database
-from supabase_http import supabase
 
+# Модули ниже читают настройки из окружения при импорте
 load_dotenv()
+
+import metrics
+from db import AsyncDatabase, MAX_DIALOGS
+from supabase_http import supabase
+from delivery import StreamingMessage, send_long_text, shorten, utf16_len, TELEGRAM_MESSAGE_LIMIT
+from openrouter import openrouter, OpenRouterBusy, NO_ANSWER
+from context_builder import ContextBuilder, token_budget
+from model_router import ModelRouter
+from scheduler import LLMScheduler, COALESCED
+from webhook import run_webhook
+from sharding import run_router, PerUserUpdateProcessor
+from supervisor import run_supervisor
+from response_cache import ResponseCache
+from retention import retention_loop
+from prompts import get_system_prompt, PROMPT_VERSIONS
+
+logger = logging.getLogger(__name__)
+
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-OPEN_ROUTER_API_KEY = os.getenv('OPEN_ROUTER_API_KEY')
 WEBSITE_URL = os.getenv('WEBSITE_URL', 'https://ai83274.vercel.app/')
+# Сколько обновлений Application обрабатывает одновременно; обновления одного пользователя — по очереди
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '64'))
+# Адрес Bot API; переопределяется для локальных стендов без настоящего Telegram
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
+# Уровень логов: трассы, обслуживание базы и супервизор пишут на INFO
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+db = AsyncDatabase()
+context_builder = ContextBuilder(db, openrouter)
+model_router = ModelRouter(openrouter)
+llm_scheduler = LLMScheduler()
+response_cache = ResponseCache()
+update_processor = PerUserUpdateProcessor(UPDATE_WORKERS)
+metrics.register_stats('llm_scheduler', llm_scheduler.stats)
+metrics.register_stats('update_processor', update_processor.stats)
+metrics.register_stats('response_cache', response_cache.stats)
+metrics.register_stats('user_cache', lambda: db.cache_stats()['users'])
+metrics.register_stats('session_cache', lambda: db.cache_stats()['sessions'])
+metrics.register_stats('write_buffer', db.buffer.stats)
+metrics.register_stats('model_router', model_router.stats)
+metrics.register_stats('system_prompt_version', lambda: dict(PROMPT_VERSIONS))
+for _model, _state in model_router.models.items():
+    metrics.register_stats(f'model:{_model}', _state.stats)
+metrics_runner = None
+retention_task = None
+db_init_task = None
+# Время от запуска процесса до этапов старта, секунды
+startup_times = {}
+metrics.register_stats('startup', lambda: dict(startup_times))
+# Контекст собирается под модель пула с самым маленьким бюджетом: ответить может любая из них
+CONTEXT_MODEL = min(model_router.models, key=token_budget)
+# Результатов поиска на одной странице
+SEARCH_PAGE_SIZE = 5
+# Сколько символов запроса повторять в заголовке результатов поиска
+SEARCH_QUERY_ECHO = 100
+# Сколько последних поисков пользователя можно листать кнопкой «Ещё»
+SEARCH_REMEMBERED = 10
+# При оценке ожидания дольше этого пользователь сразу получает сообщение о месте в очереди
+LLM_QUEUE_NOTICE_WAIT = float(os.getenv('LLM_QUEUE_NOTICE_WAIT', '5'))
+# Потоковая выдача ответа с редактированием сообщения; 0 — ждать полный ответ
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+
+# Неизменяемые объекты PTB: собираются один раз и переиспользуются во всех ответах
+MAIN_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("💬 Продолжить диалог")],
+    [KeyboardButton("🌐 Доступ к сайту"), KeyboardButton("🔄 Новый диалог")],
+    [KeyboardButton("👀 Мои диалоги"), KeyboardButton("❓ Помощь")]
+], resize_keyboard=True, one_time_keyboard=False)
+
+HELP_TEXT = """
+📋 Как пользоваться:
 
-db = Database()
-AI_MODEL = "openai/gpt-4o-mini"
-MAX_DIALOGS = 5
-
-def get_main_keyboard():
-    keyboard = [
-        [KeyboardButton("💬 Продолжить диалог")],
-        [KeyboardButton("🌐 Доступ к сайту"), KeyboardButton("🔄 Новый диалог")],
-        [KeyboardButton("👀 Мои диалоги"), KeyboardButton("❓ Помощь")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-
-def get_system_prompt() -> str:
-    return """
-ВСЕГДА соблюдай эти правила форматирования:
-1. НЕ используй Markdown разметку (**жирный**, *курсив*, ### заголовки)
-2. НЕ используй эмодзи в основном тексте ответа
-3. Используй только простые символы для структуры: -, •, цифры
-4. Разделяй длинные ответы на логические блоки
-5. Форматируй так, чтобы текст можно было легко копировать в Word
-6. Используй пустые строки между абзацами
-7. Если нужны заголовки - пиши их с новой строки без специальных символов
-
-Отвечай на русском языке.
-
-Ты - умный и полезный помощник. Отвечай на вопросы, помогай с учебой, работой, творчеством и любыми другими задачами. Будь дружелюбным и профессиональным.
-"""
+💬 Продолжить диалог - вернуться к текущему диалогу
+🌐 Доступ к сайту - получить логин/пароль для сайта
+🔄 Новый диалог - начать новую тему (до 5 параллельных диалогов)
+👀 Мои диалоги - просмотреть и управлять диалогами
+
+Просто напиши свой вопрос в любое время!
+
+Команды:
+/start — начать заново
+/search — поиск по истории диалогов
+/help — эта справка
+    """
 
 def generate_credentials():
     """Генерирует логин и пароль для сайта"""
@@ -52,11 +109,12 @@ def generate_credentials():
     
     return login, password
 
+@metrics.traced_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_id = user.id
-    db.save_user(user_id, user.username, user.first_name)
-    db.set_user_session(user_id, "general", 1)
+    await db.save_user(user_id, user.username, user.first_name)
+    await db.set_user_session(user_id, "general", 1)
     
     welcome_text = f"""
 🤖 Привет, {user.first_name}!
@@ -70,32 +128,20 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Помогать с учебой и работой
 • Создавать конспекты и объяснять сложное
 • И многое другое!"""
-    await update.message.reply_text(welcome_text, reply_markup=get_main_keyboard())
+    await update.message.reply_text(welcome_text, reply_markup=MAIN_KEYBOARD)
 
+@metrics.traced_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = """
-📋 Как пользоваться:
-
-💬 Продолжить диалог - вернуться к текущему диалогу
-🌐 Доступ к сайту - получить логин/пароль для сайта
-🔄 Новый диалог - начать новую тему (до 5 параллельных диалогов)
-👀 Мои диалоги - просмотреть и управлять диалогами
-
-Просто напиши свой вопрос в любое время!
-
-Команды:
-/start — начать заново
-/help — эта справка
-    """
-    await update.message.reply_text(help_text, reply_markup=get_main_keyboard())
+    await update.message.reply_text(HELP_TEXT, reply_markup=MAIN_KEYBOARD)
 
+@metrics.traced_handler
 async def website_access_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выдает доступ к сайту"""
     user = update.message.from_user
     user_id = user.id
     
     # Проверяем существующие credentials в Supabase
-    existing_credentials = supabase.get_website_credentials(user_id)
+    existing_credentials = await supabase.get_website_credentials(user_id)
     
     if existing_credentials:
         login = existing_credentials['login']
@@ -105,7 +151,7 @@ async def website_access_command(update: Update, context: ContextTypes.DEFAULT_T
     else:
         # Генерируем новые credentials
         login, password = generate_credentials()
-        supabase.save_website_credentials(user_id, login, password, 'free')
+        await supabase.save_website_credentials(user_id, login, password, 'free')
         subscription_type = 'free'
         is_active = True
     
@@ -124,8 +170,9 @@ async def website_access_command(update: Update, context: ContextTypes.DEFAULT_T
 ⚠️ Не передавай логин и пароль другим людям.
 """
 
-    await update.message.reply_text(access_text, reply_markup=get_main_keyboard())
+    await update.message.reply_text(access_text, reply_markup=MAIN_KEYBOARD)
 
+@metrics.traced_handler
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -135,17 +182,70 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if data.startswith("delete_dialog_"):
         dialog_id = int(data.split("_")[-1])
-        db.delete_dialog(user_id, dialog_id)
+        await db.delete_dialog(user_id, dialog_id)
         await query.edit_message_text(f"🗑 Диалог {dialog_id} удалён.")
         await asyncio.sleep(2)
         await show_all_dialogs(update, context, from_callback=True)
     elif data == "back_to_dialogs":
         await show_all_dialogs(update, context, from_callback=True)
+    elif data.startswith("search_more:"):
+        # Запрос ищется по сообщению с кнопкой: кнопки прошлых поисков листают свои результаты
+        search_query = context.user_data.get('searches', {}).get(query.message.message_id)
+        if not search_query:
+            await query.edit_message_text("🔎 Поиск устарел. Повторите запрос: /search <слова>")
+            return
+        text, reply_markup = await render_search_page(user_id, search_query, data[len("search_more:"):])
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+@metrics.traced_handler
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск по истории всех диалогов пользователя"""
+    search_query = ' '.join(context.args).strip()
+    if not search_query:
+        await update.message.reply_text(
+            "🔎 Напишите, что найти, после команды.\nНапример: /search квадратные уравнения",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return
+    text, reply_markup = await render_search_page(update.message.from_user.id, search_query)
+    results_msg = await update.message.reply_text(text, reply_markup=reply_markup)
+    if reply_markup is None:
+        return
+    # Следующие страницы листаются кнопкой, в callback_data помещается только курсор,
+    # поэтому запрос запоминается под id сообщения с результатами
+    searches = context.user_data.setdefault('searches', {})
+    searches[results_msg.message_id] = search_query
+    while len(searches) > SEARCH_REMEMBERED:
+        searches.pop(next(iter(searches)))
+
+async def render_search_page(user_id: int, search_query: str, cursor=None):
+    results, next_cursor = await db.search_conversations(user_id, search_query, SEARCH_PAGE_SIZE, cursor)
+    echo = shorten(search_query, SEARCH_QUERY_ECHO)
+    if not results:
+        if cursor:
+            return f"🔎 Больше ничего не найдено по запросу «{echo}».", None
+        return f"🔎 По запросу «{echo}» ничего не найдено.", None
+
+    text = f"🔎 Найдено по запросу «{echo}»:\n\n"
+    headings = []
+    for result in results:
+        author = "👤 Вы" if result['role'] == 'user' else "🤖 Бот"
+        when = f", {result['created_at']:%d.%m.%Y}" if result['created_at'] else ""
+        headings.append(f"{author} — диалог {result['dialog_id']}{when}\n")
+    # Страница должна уместиться в одно сообщение: остаток лимита делится между фрагментами поровну
+    spare = TELEGRAM_MESSAGE_LIMIT - utf16_len(text) - sum(utf16_len(h) + 2 for h in headings)
+    snippet_limit = spare // len(results)
+    for heading, result in zip(headings, results):
+        text += f"{heading}{shorten(result['snippet'], snippet_limit)}\n\n"
+    reply_markup = None
+    if next_cursor:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Ещё ▶️", callback_data=f"search_more:{next_cursor}")]])
+    return text, reply_markup
 
 async def show_all_dialogs(update: Update, context: ContextTypes.DEFAULT_TYPE, from_callback=False):
     user_id = update.callback_query.from_user.id if from_callback else update.message.from_user.id
     
-    summaries = db.get_all_dialogs_summary(user_id)
+    summaries = await db.get_all_dialogs_summary(user_id)
     active_count = sum(1 for v in summaries.values() if v is not None)
     
     text = "📁 Ваши диалоги (макс. 5):\n\n"
@@ -171,124 +271,255 @@ async def show_all_dialogs(update: Update, context: ContextTypes.DEFAULT_TYPE, f
     else:
         await update.message.reply_text(text, reply_markup=reply_markup)
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_message = update.message.text
+async def new_dialog_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    user_id = user.id
-    db.save_user(user_id, user.username, user.first_name)
-    
-    # Обработка специальных кнопок
-    if user_message == "🔄 Новый диалог":
-        current_mode, current_dialog = db.get_user_session(user_id)
-        summaries = db.get_all_dialogs_summary(user_id)
-        active_count = sum(1 for v in summaries.values() if v is not None)
-        
-        if active_count >= MAX_DIALOGS:
-            await update.message.reply_text(
-                "⚠️ У вас уже 5 активных диалогов. "
-                "Сначала удалите ненужные через «👀 Мои диалоги».",
-                reply_markup=get_main_keyboard()
-            )
-            return
-        
-        new_dialog_id = next((i for i in range(1, MAX_DIALOGS + 1) if summaries[i] is None), 1)
-        db.set_user_session(user_id, "general", new_dialog_id)
-        db.clear_conversation_history(user_id, new_dialog_id)
+    await db.save_user(user.id, user.username, user.first_name)
+    # Выбор свободного диалога и переключение сессии — одна транзакция в базе
+    new_dialog_id = await db.start_new_dialog(user.id, "general")
+    if new_dialog_id is None:
         await update.message.reply_text(
-            f"🔄 Начат новый диалог №{new_dialog_id}! Пишите ваш запрос.",
-            reply_markup=get_main_keyboard()
+            "⚠️ У вас уже 5 активных диалогов. "
+            "Сначала удалите ненужные через «👀 Мои диалоги».",
+            reply_markup=MAIN_KEYBOARD
         )
         return
 
-    elif user_message == "👀 Мои диалоги":
-        await show_all_dialogs(update, context)
+    await update.message.reply_text(
+        f"🔄 Начат новый диалог №{new_dialog_id}! Пишите ваш запрос.",
+        reply_markup=MAIN_KEYBOARD
+    )
+
+async def continue_dialog_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    current_mode, current_dialog = await db.get_user_session(update.message.from_user.id)
+    await update.message.reply_text(
+        f"💬 Продолжаем диалог №{current_dialog}. Пишите ваш запрос:",
+        reply_markup=MAIN_KEYBOARD
+    )
+
+# Кнопки главного меню проверяются до любых обращений к базе;
+# чистая навигация не пишет пользователя в базу
+MENU_ACTIONS = {
+    "🔄 Новый диалог": new_dialog_button,
+    "👀 Мои диалоги": show_all_dialogs,
+    "🌐 Доступ к сайту": website_access_command,
+    "❓ Помощь": help_command,
+    "💬 Продолжить диалог": continue_dialog_button
+}
+
+@metrics.traced_handler
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_message = update.message.text
+    action = MENU_ACTIONS.get(user_message)
+    if action is not None:
+        await action(update, context)
         return
 
-    elif user_message == "🌐 Доступ к сайту":
-        await website_access_command(update, context)
+    # Обычное сообщение — отправка в AI. Допуск проверяется до обращений к базе:
+    # отклонённый запрос не стоит ничего, кроме ответа пользователю
+    user_id = update.message.from_user.id
+    admission = llm_scheduler.admit(user_id)
+    if not admission.accepted:
+        await update.message.reply_text(
+            f"⏳ Сейчас слишком много запросов. Попробуйте ещё раз через {format_wait(admission.wait)}.",
+            reply_markup=MAIN_KEYBOARD
+        )
         return
 
-    elif user_message == "❓ Помощь":
-        await help_command(update, context)
+    # Место в очереди уже занято admit(): если до submit() не дойдём, его нужно вернуть
+    try:
+        user = update.message.from_user
+        await db.save_user(user_id, user.username, user.first_name)
+        current_mode, current_dialog = await db.get_user_session(user_id)
+        await db.save_conversation(user_id, "user", user_message, "general", current_dialog)
+
+        queued = admission.wait >= LLM_QUEUE_NOTICE_WAIT
+        if queued:
+            thinking_msg = await update.message.reply_text(
+                f"🕒 Запрос в очереди, позиция {admission.position}. "
+                f"Примерное ожидание — {format_wait(admission.wait)}. Ответ начнётся автоматически."
+            )
+        else:
+            await update.message.chat.send_action(action="typing")
+            thinking_msg = await update.message.reply_text("💭 Думаю...")
+    except BaseException:
+        admission.release()
+        raise
+
+    async def answer():
+        if queued:
+            try:
+                await thinking_msg.edit_text("💭 Думаю...")
+                await update.message.chat.send_action(action="typing")
+            except TelegramError:
+                pass
+        await reply_with_ai(update, thinking_msg, user_id, current_dialog, current_mode)
+
+    # Ответ ждёт в очереди планировщика вне обработчика: слоты concurrent_updates
+    # не заняты ожиданием модели, и кнопки меню отвечают при любой очереди
+    context.application.create_task(
+        answer_when_scheduled(update, user_id, answer, thinking_msg, admission), update=update
+    )
+
+async def answer_when_scheduled(update: Update, user_id: int, answer, thinking_msg, admission):
+    # Трасса обработчика к этому моменту уже записана: ответ пишет свою, со спанами базы и модели
+    with metrics.traced(f'update={update.update_id} job=answer'):
+        result = await llm_scheduler.submit(user_id, answer, admission)
+    if result is COALESCED:
+        # Пока ждали очереди, пришло новое сообщение: ответим на него, история уже содержит оба
+        await thinking_msg.delete()
+
+def format_wait(seconds: float) -> str:
+    if seconds < 60:
+        return f"{max(5, round(seconds / 5) * 5)} с"
+    return f"{round(seconds / 60)} мин"
+
+async def reply_with_ai(update: Update, thinking_msg, user_id: int, dialog_id: int, mode: str):
+    """Собирает контекст, запрашивает модель и отправляет ответ"""
+    # История уже содержит только что сохранённое сообщение пользователя
+    messages = await context_builder.build(user_id, dialog_id, get_system_prompt(mode), CONTEXT_MODEL)
+
+    # Подходит ответ любой модели пула; сохраняется он под той, что ответила
+    cached = response_cache.lookup(messages, list(model_router.models))
+    if cached is not None:
+        reply = StreamingMessage(thinking_msg)
+        await reply.append(cached)
+        await reply.finish()
+        await db.save_conversation(user_id, "assistant", cached, "general", dialog_id)
         return
 
-    elif user_message == "💬 Продолжить диалог":
-        current_mode, current_dialog = db.get_user_session(user_id)
-        await update.message.reply_text(
-            f"💬 Продолжаем диалог №{current_dialog}. Пишите ваш запрос:",
-            reply_markup=get_main_keyboard()
-        )
+    if STREAM_RESPONSES:
+        await stream_reply(update, thinking_msg, messages, user_id, dialog_id)
         return
 
-    # Обычное сообщение — отправка в AI
-    current_mode, current_dialog = db.get_user_session(user_id)
-    db.save_conversation(user_id, "user", user_message, "general", current_dialog)
-    
-    await update.message.chat.send_action(action="typing")
-    thinking_msg = await update.message.reply_text("💭 Думаю...")
-    
-    system_prompt = get_system_prompt()
-    history = db.get_conversation_history(user_id, current_dialog, limit=3)
-    
-    messages = [{"role": "system", "content": system_prompt}]
-    for role, content, _ in history:
-        messages.append({"role": role, "content": content})
-    messages.append({"role": "user", "content": user_message})
-    
     try:
-        ai_response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: query_openrouter_sync(messages, AI_MODEL)
-        )
+        started = time.monotonic()
+        answered = []
+        ai_response = await model_router.complete(messages, on_model=answered.append)
+        if ai_response != NO_ANSWER:
+            response_cache.store(messages, answered[0], ai_response, time.monotonic() - started)
         await thinking_msg.delete()
-        db.save_conversation(user_id, "assistant", ai_response, "general", current_dialog)
+        await db.save_conversation(user_id, "assistant", ai_response, "general", dialog_id)
         
-        if len(ai_response) > 4096:
-            for i in range(0, len(ai_response), 4096):
-                await update.message.reply_text(ai_response[i:i+4096], reply_markup=get_main_keyboard())
-        else:
-            await update.message.reply_text(ai_response, reply_markup=get_main_keyboard())
-            
+        await send_long_text(update.message, ai_response, reply_markup=MAIN_KEYBOARD)
+
+    except OpenRouterBusy as e:
+        await thinking_msg.delete()
+        await update.message.reply_text(f"⏳ {e}", reply_markup=MAIN_KEYBOARD)
     except Exception as e:
         await thinking_msg.delete()
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}", reply_markup=get_main_keyboard())
-
-def query_openrouter_sync(messages: list, model: str = AI_MODEL) -> str:
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPEN_ROUTER_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": model,
-        "messages": messages,
-        "max_tokens": 15000
-    }
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+async def stream_reply(update: Update, thinking_msg, messages: list, user_id: int, dialog_id: int):
+    """Выводит ответ AI по мере генерации, редактируя сообщение «Думаю...»"""
+    reply = StreamingMessage(thinking_msg)
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-        if 'choices' in result and len(result['choices']) > 0:
-            return result['choices'][0]['message']['content']
-        else:
-            return "Не удалось получить ответ от AI."
+        started = time.monotonic()
+        answered = []
+        async for delta in model_router.stream(messages, on_model=answered.append):
+            await reply.append(delta)
+        ai_response = await reply.finish()
+        if reply.has_content:
+            response_cache.store(messages, answered[0], ai_response, time.monotonic() - started)
+        await db.save_conversation(user_id, "assistant", ai_response, "general", dialog_id)
+    except OpenRouterBusy as e:
+        await thinking_msg.delete()
+        await update.message.reply_text(f"⏳ {e}", reply_markup=MAIN_KEYBOARD)
     except Exception as e:
-        return f"Ошибка: {str(e)}"
+        if not reply.has_content:
+            await thinking_msg.delete()
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}", reply_markup=MAIN_KEYBOARD)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print(f"Update {update} caused error {context.error}")
+    # Сюда попадают и ошибки задач context.application.create_task (ответы модели)
+    metrics.OPERATION_ERRORS.inc('application', 'unhandled_error')
+    update_id = getattr(update, 'update_id', None)
+    logger.error(f"Update {update_id} caused error {context.error!r}", exc_info=context.error)
 
-def main():
-    db.init_db()
-    app = Application.builder().token(TOKEN).build()
+async def init_database():
+    """Подключение к базе и проверка версии схемы в фоне после старта"""
+    try:
+        applied = await db.init_db()
+    except Exception as e:
+        print(f"Ошибка подключения к базе: {e}")
+        return
+    startup_times['database'] = time.monotonic() - STARTED_AT
+    if applied:
+        print(f"Применены миграции схемы: {applied}")
+
+async def on_startup(app: Application):
+    global metrics_runner, retention_task, db_init_task
+    # Старт не ждёт базу: меню и справка отвечают сразу, а первый запрос к базе
+    # дождётся окончания init_db
+    db_init_task = asyncio.create_task(init_database())
+    if metrics.METRICS_PORT:
+        metrics_runner = await metrics.start_metrics_server()
+    retention_task = asyncio.create_task(retention_loop(db))
+    startup_times['ready'] = time.monotonic() - STARTED_AT
+    print(f"Готов принимать обновления через {startup_times['ready']:.2f} с после запуска "
+          f"(импорт модулей {startup_times['imports']:.2f} с)")
+
+async def on_shutdown(app: Application):
+    if db_init_task is not None:
+        await asyncio.gather(db_init_task, return_exceptions=True)
+    if retention_task is not None:
+        retention_task.cancel()
+        await asyncio.gather(retention_task, return_exceptions=True)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await openrouter.close()
+    await supabase.close()
+    await db.close()
+
+def build_application() -> Application:
+    """Собирает Application со всеми обработчиками"""
+    builder = Application.builder().token(TOKEN).concurrent_updates(update_processor)
+    builder = builder.post_init(on_startup).post_shutdown(on_shutdown)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    app = builder.build()
     
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("search", search_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_error_handler(error_handler)
+    return app
+
+startup_times['imports'] = time.monotonic() - STARTED_AT
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram-бот с AI-помощником")
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'router'], default=os.getenv('BOT_MODE', 'polling'),
+                        help="получение обновлений: long polling, webhook или маршрутизатор webhook "
+                             "для нескольких воркеров (по умолчанию BOT_MODE)")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BOT_WORKERS', '1')),
+                        help="число процессов-воркеров; больше 1 — запуск через супервизор (по умолчанию BOT_WORKERS)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # httpx пишет на INFO каждый запрос к Bot API, включая long polling
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    if args.mode == 'router':
+        print("Маршрутизатор обновлений запущен...")
+        asyncio.run(run_router(TOKEN))
+        return
+
+    if args.workers > 1:
+        # Миграции — один раз до запуска воркеров, воркерам остаётся быстрая проверка версии
+        db.sync.init_db()
+        print(f"Супервизор запускает {args.workers} воркеров в режиме {args.mode}...")
+        run_supervisor(TOKEN, args.workers, args.mode)
+        return
+    app = build_application()
     
-    print(f"Бот запущен с моделью {AI_MODEL}...")
-    app.run_polling(poll_interval=3)
+    print(f"Бот запущен с моделями {', '.join(model_router.models)} в режиме {args.mode}...")
+    if args.mode == 'webhook':
+        asyncio.run(run_webhook(app))
+    else:
+        # Long polling: Telegram держит запрос открытым до прихода обновления, пауза между запросами не нужна
+        app.run_polling(poll_interval=0, timeout=30)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
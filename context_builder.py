@@ -0,0 +1,149 @@
+import os
+import asyncio
+import logging
+from openrouter import NO_ANSWER
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов на весь запрос (системный промпт + краткое содержание + история) по моделям
+MODEL_TOKEN_BUDGETS = {
+    'openai/gpt-4o-mini': 8000,
+}
+DEFAULT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '4000'))
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+HISTORY_PAGE_SIZE = 50
+
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'openai/gpt-4o-mini')
+SUMMARY_MAX_TOKENS = 600
+# Сколько токенов истории сворачивать в краткое содержание за один вызов модели
+SUMMARY_CHUNK_TOKENS = 3000
+SUMMARY_MAX_PASSES = 5
+# Слишком длинные сообщения при сворачивании обрезаются
+SUMMARY_MESSAGE_CHARS = 2000
+
+SUMMARY_PROMPT = """Ты ведёшь краткое содержание диалога пользователя с ассистентом.
+Дополни текущее краткое содержание новыми сообщениями. Сохрани факты, договорённости,
+имена, цифры и незакрытые вопросы, опусти повторы и вежливые формулы.
+Пиши сжато, на русском языке, не длиннее 250 слов. Ответь только кратким содержанием."""
+
+ROLE_NAMES = {'user': 'Пользователь', 'assistant': 'Ассистент'}
+
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов: примерно 4 байта UTF-8 на токен.
+
+    Для кириллицы это около двух символов на токен — с небольшим запасом
+    относительно реальных BPE-токенизаторов.
+    """
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def message_tokens(content: str) -> int:
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def token_budget(model: str) -> int:
+    return MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+
+class ContextBuilder:
+    """Собирает messages для модели в пределах бюджета токенов.
+
+    Берёт самые свежие сообщения диалога, пока они помещаются в бюджет.
+    Всё, что старше, сворачивается в краткое содержание, которое хранится
+    в dialogs и обновляется инкрементально в фоне.
+    """
+    def __init__(self, db, llm, summary_model: str = SUMMARY_MODEL):
+        self.db = db
+        self.llm = llm
+        self.summary_model = summary_model
+        self._summarizing = set()
+        self._tasks = set()
+
+    async def build(self, user_id: int, dialog_id: int, system_prompt: str, model: str) -> list:
+        """Возвращает messages: системный промпт, краткое содержание и помещающаяся история"""
+        budget = token_budget(model)
+        summary, summary_upto_id = await self.db.get_dialog_summary(user_id, dialog_id)
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if summary:
+            messages.append({"role": "system", "content": f"Краткое содержание предыдущей части диалога:\n{summary}"})
+        used = sum(message_tokens(m["content"]) for m in messages)
+
+        history = []
+        before_id = None
+        overflow = False
+        while not overflow:
+            rows = await self.db.get_history_window(
+                user_id, dialog_id, after_id=summary_upto_id, before_id=before_id, limit=HISTORY_PAGE_SIZE
+            )
+            for row_id, role, content in rows:
+                cost = message_tokens(content)
+                # Самое свежее сообщение берём всегда, даже если оно одно не влезает в бюджет
+                if history and used + cost > budget:
+                    overflow = True
+                    break
+                history.append({"role": role, "content": content})
+                used += cost
+                # У ещё не записанных в базу сообщений id нет
+                if row_id is not None:
+                    before_id = row_id
+            if len(rows) < HISTORY_PAGE_SIZE or rows[-1][0] is None:
+                break
+
+        if overflow:
+            # Всё между summary_upto_id и самым старым попавшим сообщением пора свернуть
+            self._schedule_summary(user_id, dialog_id, before_id)
+
+        history.reverse()
+        return messages + history
+
+    def _schedule_summary(self, user_id: int, dialog_id: int, boundary_id: int):
+        key = (user_id, dialog_id)
+        if key in self._summarizing:
+            return
+        self._summarizing.add(key)
+        task = asyncio.create_task(self._update_summary(user_id, dialog_id, boundary_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update_summary(self, user_id: int, dialog_id: int, boundary_id: int):
+        """Сворачивает сообщения старше boundary_id в краткое содержание, порциями"""
+        try:
+            summary, upto_id = await self.db.get_dialog_summary(user_id, dialog_id)
+            for _ in range(SUMMARY_MAX_PASSES):
+                rows = await self.db.get_history_window(
+                    user_id, dialog_id, after_id=upto_id, before_id=boundary_id,
+                    limit=HISTORY_PAGE_SIZE, newest_first=False
+                )
+                if not rows:
+                    break
+                chunk = []
+                tokens = 0
+                for row in rows:
+                    tokens += message_tokens(row[2][:SUMMARY_MESSAGE_CHARS])
+                    if chunk and tokens > SUMMARY_CHUNK_TOKENS:
+                        break
+                    chunk.append(row)
+
+                transcript = '\n\n'.join(
+                    f"{ROLE_NAMES.get(role, role)}: {content[:SUMMARY_MESSAGE_CHARS]}"
+                    for _, role, content in chunk
+                )
+                prompt = [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Текущее краткое содержание:\n{summary or 'пока нет'}\n\nНовые сообщения:\n{transcript}"}
+                ]
+                updated = await self.llm.complete(prompt, self.summary_model, max_tokens=SUMMARY_MAX_TOKENS)
+                if not updated or not updated.strip() or updated == NO_ANSWER:
+                    # upto_id не сдвигаем: эти сообщения свернутся при следующем проходе
+                    logger.warning(f"Empty summary for dialog {user_id}/{dialog_id}, will retry")
+                    break
+                summary = updated
+                upto_id = chunk[-1][0]
+                await self.db.save_dialog_summary(user_id, dialog_id, summary, upto_id)
+        except Exception as e:
+            logger.error(f"Error updating summary for dialog {user_id}/{dialog_id}: {e}")
+        finally:
+            self._summarizing.discard((user_id, dialog_id))
@@ -0,0 +1,211 @@
+import io
+import os
+import time
+import asyncio
+from telegram import InputFile
+from telegram.error import BadRequest, RetryAfter
+from cache import TTLCache
+from scheduler import TokenBucket
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Telegram позволяет примерно одно редактирование в секунду на чат
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+# Лимиты Telegram на отправку: около сообщения в секунду на чат с короткими всплесками
+# и около 30 сообщений в секунду на бота
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', '1'))
+CHAT_SEND_BURST = int(os.getenv('CHAT_SEND_BURST', '3'))
+GLOBAL_SEND_RATE = float(os.getenv('GLOBAL_SEND_RATE', '30'))
+# Ответ длиннее стольких символов отправляется файлом, а не пачкой сообщений
+DOCUMENT_THRESHOLD = int(os.getenv('LONG_REPLY_DOCUMENT_CHARS', str(TELEGRAM_MESSAGE_LIMIT * 4)))
+SEND_RETRIES = 3
+
+_SENTENCE_ENDS = '.!?…'
+
+
+def find_split_point(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT, start: int = 0) -> int:
+    """Конец первого куска text[start:], который помещается в limit.
+
+    Длина считается в единицах UTF-16, как у Telegram (эмодзи вне BMP — две).
+    Разрыв ищется за один проход: граница абзаца, иначе строки, предложения,
+    слова, и только если таких нет во второй половине куска — жёсткая граница.
+    """
+    units = 0
+    best = [0, 0, 0, 0]  # последние границы: абзац, строка, предложение, слово
+    i = start
+    while i < len(text):
+        ch = text[i]
+        units += 2 if ord(ch) > 0xFFFF else 1
+        if units > limit:
+            break
+        i += 1
+        if ch == '\n':
+            best[1] = i
+            if i - 2 >= start and text[i - 2] == '\n':
+                best[0] = i
+        elif ch.isspace():
+            best[3] = i
+            if i - 2 >= start and text[i - 2] in _SENTENCE_ENDS:
+                best[2] = i
+    else:
+        return len(text)
+    # Граница в первой половине дала бы слишком короткий кусок
+    for pos in best:
+        if pos - start > (i - start) // 2:
+            return pos
+    return max(i, start + 1)
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+def shorten(text: str, limit: int) -> str:
+    """text, укороченный до limit единиц UTF-16 по границе слова, с многоточием"""
+    if utf16_len(text) <= limit:
+        return text
+    return text[:find_split_point(text, max(1, limit - 1))].rstrip() + '…'
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """Делит текст на сообщения по границам абзацев и предложений"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = find_split_point(text, limit, start)
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        start = end
+    return chunks
+
+
+class SendRateLimiter:
+    """Локальный ограничитель отправки: token bucket на каждый чат и общий на бота"""
+    def __init__(self, rate: float = CHAT_SEND_RATE, burst: int = CHAT_SEND_BURST,
+                 global_rate: float = GLOBAL_SEND_RATE):
+        self.rate = rate
+        self.burst = burst
+        # Бакет неактивного чата за минуту всё равно наполнился бы — его можно забыть
+        self._chats = TTLCache(maxsize=100000, ttl=60)
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+
+    async def acquire(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._chats.set(chat_id, bucket)
+        await bucket.acquire()
+        await self._global.acquire()
+
+
+send_limiter = SendRateLimiter()
+
+
+async def _send(chat_id, method, *args, **kwargs):
+    """Отправка через ограничитель; на RetryAfter от Telegram ждёт и повторяет"""
+    for attempt in range(SEND_RETRIES):
+        await send_limiter.acquire(chat_id)
+        try:
+            return await method(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == SEND_RETRIES - 1:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+
+async def _send_document(chat_id, method, text: str, reply_markup=None):
+    document = InputFile(io.BytesIO(text.encode('utf-8')), filename='answer.txt')
+    return await _send(chat_id, method, document,
+                       caption="📄 Ответ получился длинным, поэтому он в файле.", reply_markup=reply_markup)
+
+
+async def send_long_text(message, text: str, reply_markup=None):
+    """Отвечает на message текстом любой длины.
+
+    Части уходят подряд по границам абзацев и предложений, клавиатура
+    прикрепляется только к последней; совсем длинный ответ — файлом.
+    """
+    chat_id = message.chat_id
+    if len(text) > DOCUMENT_THRESHOLD:
+        await _send_document(chat_id, message.reply_document, text, reply_markup)
+        return
+    chunks = split_message(text) or ['…']
+    for i, chunk in enumerate(chunks):
+        await _send(chat_id, message.reply_text, chunk,
+                    reply_markup=reply_markup if i == len(chunks) - 1 else None)
+
+
+class StreamingMessage:
+    """Показывает ответ по мере генерации, редактируя сообщение-заглушку.
+
+    Редактирования троттлятся, а при превышении лимита Telegram
+    текст переносится в новое сообщение. Ответ длиннее document_threshold
+    дальше не показывается по частям: он собирается целиком и уходит файлом.
+    """
+    def __init__(self, placeholder, edit_interval: float = STREAM_EDIT_INTERVAL,
+                 document_threshold: int = DOCUMENT_THRESHOLD):
+        self.message = placeholder
+        self.edit_interval = edit_interval
+        self.document_threshold = document_threshold
+        self.as_document = False
+        self.full_text = ''
+        self._text = ''
+        self._shown = None
+        self._next_edit_at = 0.0
+
+    @property
+    def has_content(self) -> bool:
+        return bool(self.full_text)
+
+    async def append(self, delta: str):
+        self.full_text += delta
+        if self.as_document:
+            return
+        if len(self.full_text) > self.document_threshold:
+            self.as_document = True
+            await self._edit("📄 Ответ получился длинным — пришлю его целиком файлом, когда он будет готов.",
+                             force=True)
+            return
+        self._text += delta
+        while utf16_len(self._text) > TELEGRAM_MESSAGE_LIMIT:
+            cut = find_split_point(self._text)
+            head, self._text = self._text[:cut], self._text[cut:]
+            await self._edit(head, force=True)
+            self.message = await _send(self.message.chat_id, self.message.chat.send_message, self._text or '…')
+            self._shown = self._text or '…'
+        await self._edit(self._text)
+
+    async def finish(self, fallback: str = 'Не удалось получить ответ от AI.') -> str:
+        """Дописывает остаток текста и возвращает полный ответ"""
+        if self.as_document:
+            await _send_document(self.message.chat_id, self.message.chat.send_document, self.full_text)
+            return self.full_text
+        if not self.full_text:
+            self._text = fallback
+        await self._edit(self._text, force=True)
+        return self.full_text or fallback
+
+    async def _edit(self, text: str, force: bool = False):
+        text = text.strip() or '…'
+        if text == self._shown:
+            return
+        now = time.monotonic()
+        if not force and now < self._next_edit_at:
+            return
+        if force and now < self._next_edit_at:
+            await asyncio.sleep(self._next_edit_at - now)
+        try:
+            await self.message.edit_text(text)
+            self._shown = text
+        except RetryAfter as e:
+            if not force:
+                self._next_edit_at = time.monotonic() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
+            await self.message.edit_text(text)
+            self._shown = text
+        except BadRequest as e:
+            # Текст мог не измениться после strip() — это не ошибка
+            if 'not modified' not in str(e).lower():
+                raise
+        self._next_edit_at = time.monotonic() + self.edit_interval
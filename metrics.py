@@ -0,0 +1,297 @@
+"""Метрики в формате Prometheus и трассировка обработки обновлений.
+
+Метрики включаются переменной METRICS_PORT (порт HTTP-эндпоинта /metrics),
+трассировка — TRACE_UPDATES=1. Когда и то и другое выключено, обёртки
+сводятся к одной проверке флага.
+"""
+import os
+import time
+import logging
+import threading
+import inspect
+import functools
+import contextvars
+from contextlib import contextmanager
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+TRACE_UPDATES = os.getenv('TRACE_UPDATES', '0') == '1'
+# Трассы быстрее порога не пишутся в лог
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '0'))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_enabled = METRICS_PORT > 0 or TRACE_UPDATES
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # callback() -> {кортеж меток: значение}, вычисляется при каждом чтении /metrics
+        self.callback = callback
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        lines = self.header()
+        values = self.callback() if self.callback else self._values
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    def render(self):
+        lines = self.header()
+        for labels, (counts, total, value_sum) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _format_labels(self.labelnames + ('le',), labels + (bound,))
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = _format_labels(self.labelnames + ('le',), labels + ('+Inf',))
+            lines.append(f'{self.name}_bucket{le} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {value_sum}')
+        return lines
+
+
+REGISTRY = []
+
+OPERATION_DURATION = Histogram('bot_operation_duration_seconds', 'Длительность операции', ('component', 'operation'))
+OPERATION_ERRORS = Counter('bot_operation_errors_total', 'Операции, завершившиеся ошибкой', ('component', 'operation'))
+OPERATIONS_IN_FLIGHT = Gauge('bot_operations_in_flight', 'Выполняющиеся сейчас операции', ('component', 'operation'))
+LLM_TOKENS = Counter('bot_llm_tokens_total', 'Токены, потраченные на запросы к модели', ('model', 'kind'))
+LLM_FIRST_TOKEN = Histogram('bot_llm_time_to_first_token_seconds', 'Время до первого токена ответа', ('model',))
+
+# Функции stats() компонентов (кэши, очередь, буфер записи), читаются при запросе /metrics
+_stats_sources = {}
+
+
+def register_stats(component, stats_func):
+    """Публикует числовые поля stats_func() как bot_component_stat{component, stat}"""
+    _stats_sources[component] = stats_func
+
+
+def _collect_stats():
+    values = {}
+    for component, stats_func in _stats_sources.items():
+        for stat, value in stats_func().items():
+            if isinstance(value, (int, float)):
+                values[(component, stat)] = value
+    return values
+
+
+COMPONENT_STATS = Gauge('bot_component_stat', 'Внутренние счётчики компонентов', ('component', 'stat'),
+                        callback=_collect_stats)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def record_tokens(model, usage):
+    """Учитывает usage из ответа OpenRouter"""
+    if not _enabled or not usage:
+        return
+    LLM_TOKENS.inc(model, 'prompt', amount=usage.get('prompt_tokens', 0))
+    LLM_TOKENS.inc(model, 'completion', amount=usage.get('completion_tokens', 0))
+
+
+def record_first_token(model, seconds):
+    if _enabled:
+        LLM_FIRST_TOKEN.observe(model, value=seconds)
+
+
+class Trace:
+    """Спаны одной обработки обновления"""
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []  # (компонент.операция, начало от старта трассы, длительность, ошибка)
+
+    def log(self):
+        total_ms = (time.perf_counter() - self.started) * 1000
+        if total_ms < TRACE_SLOW_MS:
+            return
+        spans = ' '.join(
+            f"{name}@{start * 1000:.0f}+{duration * 1000:.0f}ms{'!' if failed else ''}"
+            for name, start, duration, failed in sorted(self.spans, key=lambda s: s[1])
+        )
+        logger.info(f"trace {self.name} {total_ms:.0f}ms: {spans}")
+
+
+def _record(component, operation, started, failed):
+    duration = time.perf_counter() - started
+    OPERATION_DURATION.observe(component, operation, value=duration)
+    if failed:
+        OPERATION_ERRORS.inc(component, operation)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((f'{component}.{operation}', started - trace.started, duration, failed))
+
+
+@contextmanager
+def measure(component, operation):
+    """Замеряет блок кода: гистограмма задержки, счётчик ошибок, in-flight и спан трассы"""
+    if not _enabled:
+        yield
+        return
+    OPERATIONS_IN_FLIGHT.inc(component, operation)
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        OPERATIONS_IN_FLIGHT.dec(component, operation)
+        _record(component, operation, started, failed)
+
+
+def timed(component, operation=None):
+    """Декоратор measure() для обычных и асинхронных функций"""
+    def decorator(func):
+        name = operation or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with measure(component, name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with measure(component, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def traced(name):
+    """Отдельная трасса для работы вне обработчика (фоновые задачи): пишется в лог по выходе из блока"""
+    if not TRACE_UPDATES:
+        yield
+        return
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield
+    finally:
+        _current_trace.reset(token)
+        trace.log()
+
+
+def traced_handler(func):
+    """Декоратор обработчика Telegram: метрики и, при TRACE_UPDATES, трасса всего обновления"""
+    timed_func = timed('handler', func.__name__)(func)
+
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        # Обработчик, вызванный из другого обработчика, пишет спан в уже открытую трассу
+        if not TRACE_UPDATES or _current_trace.get() is not None:
+            return await timed_func(update, context, *args, **kwargs)
+        trace = Trace(f'update={getattr(update, "update_id", "?")} handler={func.__name__}')
+        token = _current_trace.set(trace)
+        try:
+            return await timed_func(update, context, *args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+            trace.log()
+    return wrapper
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = '0.0.0.0'):
+    """Поднимает HTTP-эндпоинт /metrics; возвращает runner для остановки"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,285 @@
+"""Версионированные миграции схемы.
+
+Каждая миграция выполняется один раз в своей транзакции, номер применённой
+версии записывается в schema_migrations. Параллельный запуск нескольких
+процессов сериализуется advisory-блокировкой.
+"""
+from datetime import datetime, timedelta
+
+# Произвольный ключ advisory-блокировки для миграций
+MIGRATIONS_LOCK_ID = 834_271_001
+# Сколько месячных секций conversations держать созданными наперёд
+PARTITIONS_AHEAD = 2
+
+
+def next_month(month: datetime) -> datetime:
+    return (month.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def partition_name(month: datetime) -> str:
+    return f"conversations_p{month:%Y%m}"
+
+
+def create_month_partition(cursor, month: datetime) -> int:
+    """Секция conversations за календарный месяц, начинающийся с month.
+
+    Если строки этого месяца уже попали в conversations_default (секция не
+    успела создаться, например после долгого простоя), PostgreSQL не даст
+    создать секцию поверх них. Тогда секция по умолчанию отсоединяется,
+    строки месяца переносятся в новую секцию, и секция по умолчанию
+    присоединяется обратно. Возвращает число перенесённых строк.
+    """
+    start = month.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    name = partition_name(start)
+    bounds = (start, next_month(start))
+    cursor.execute('SELECT to_regclass(%s), to_regclass(%s)', (name, 'conversations_default'))
+    exists, default = cursor.fetchone()
+    if exists is not None:
+        return 0
+    stray = False
+    if default is not None:
+        cursor.execute(
+            'SELECT EXISTS (SELECT 1 FROM conversations_default WHERE created_at >= %s AND created_at < %s)',
+            bounds
+        )
+        stray = cursor.fetchone()[0]
+    if not stray:
+        cursor.execute(f'CREATE TABLE {name} PARTITION OF conversations FOR VALUES FROM (%s) TO (%s)', bounds)
+        return 0
+    cursor.execute('ALTER TABLE conversations DETACH PARTITION conversations_default')
+    cursor.execute(f'CREATE TABLE {name} PARTITION OF conversations FOR VALUES FROM (%s) TO (%s)', bounds)
+    cursor.execute(f'''
+        WITH moved AS (
+            DELETE FROM conversations_default WHERE created_at >= %s AND created_at < %s
+            RETURNING id, user_id, role, content, mode, dialog_id, created_at
+        )
+        INSERT INTO {name} (id, user_id, role, content, mode, dialog_id, created_at)
+        SELECT id, user_id, role, content, mode, dialog_id, created_at FROM moved
+    ''', bounds)
+    moved = cursor.rowcount
+    cursor.execute('ALTER TABLE conversations ATTACH PARTITION conversations_default DEFAULT')
+    return moved
+
+
+def _initial_schema(cursor):
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица диалогов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            dialog_id INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Индекс для ускорения поиска
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_dialog
+        ON conversations (user_id, dialog_id)
+    ''')
+
+    # Таблица сессий
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id BIGINT PRIMARY KEY,
+            mode TEXT DEFAULT 'free',
+            dialog_id INTEGER DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _dialogs_table(cursor):
+    # Сводка по диалогам: поддерживается при записи, чтобы меню читало одну строку на диалог
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dialogs (
+            user_id BIGINT NOT NULL,
+            dialog_id INTEGER NOT NULL,
+            last_user_preview TEXT,
+            mode TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, dialog_id)
+        )
+    ''')
+    # Заполняем по уже существующим сообщениям
+    cursor.execute('''
+        INSERT INTO dialogs (user_id, dialog_id, last_user_preview, mode, message_count, updated_at)
+        SELECT c.user_id, c.dialog_id, lu.preview, lu.mode, c.message_count, c.updated_at
+        FROM (
+            SELECT user_id, dialog_id, COUNT(*) AS message_count, MAX(created_at) AS updated_at
+            FROM conversations
+            GROUP BY user_id, dialog_id
+        ) c
+        LEFT JOIN (
+            SELECT DISTINCT ON (user_id, dialog_id) user_id, dialog_id, LEFT(content, 200) AS preview, mode
+            FROM conversations
+            WHERE role = 'user'
+            ORDER BY user_id, dialog_id, created_at DESC, id DESC
+        ) lu ON lu.user_id = c.user_id AND lu.dialog_id = c.dialog_id
+        ON CONFLICT (user_id, dialog_id) DO NOTHING
+    ''')
+
+
+def _history_index(cursor):
+    # История читается по (user_id, dialog_id) в порядке id DESC прямо из индекса, без сортировки.
+    # content в INCLUDE не кладём: длинные ответы AI превышают лимит размера строки B-tree индекса
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_history
+        ON conversations (user_id, dialog_id, id DESC) INCLUDE (role, mode)
+    ''')
+    # Старый индекс — префикс нового и больше не нужен
+    cursor.execute('DROP INDEX IF EXISTS idx_conversations_user_dialog')
+
+
+def _dialog_summaries(cursor):
+    # Скользящее краткое содержание старой части диалога и id последнего свёрнутого сообщения
+    cursor.execute('ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS summary TEXT')
+    cursor.execute('ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS summary_upto_id BIGINT NOT NULL DEFAULT 0')
+
+
+def _partition_conversations(cursor):
+    # conversations становится секционированной по месяцам created_at: старые месяцы
+    # архивируются и удаляются целиком (retention.py), индексы и VACUUM касаются только живых данных
+    cursor.execute('ALTER TABLE conversations RENAME TO conversations_legacy')
+    cursor.execute('ALTER TABLE conversations_legacy RENAME CONSTRAINT conversations_pkey TO conversations_legacy_pkey')
+    cursor.execute('DROP INDEX IF EXISTS idx_conversations_history')
+    # Последовательность id сохраняется, чтобы id оставались монотонными (на них держится keyset-чтение)
+    cursor.execute('ALTER SEQUENCE conversations_id_seq OWNED BY NONE')
+    cursor.execute('ALTER SEQUENCE conversations_id_seq AS BIGINT')
+    cursor.execute('''
+        CREATE TABLE conversations (
+            id BIGINT NOT NULL DEFAULT nextval('conversations_id_seq'),
+            user_id BIGINT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            dialog_id INTEGER DEFAULT 1,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    ''')
+    cursor.execute('ALTER SEQUENCE conversations_id_seq OWNED BY conversations.id')
+    # Страховка на случай, если секция месяца не успела создаться
+    cursor.execute('CREATE TABLE conversations_default PARTITION OF conversations DEFAULT')
+
+    cursor.execute('''
+        SELECT date_trunc('month', COALESCE(MIN(created_at), LOCALTIMESTAMP)), date_trunc('month', LOCALTIMESTAMP)
+        FROM conversations_legacy
+    ''')
+    month, current = cursor.fetchone()
+    last = current
+    for _ in range(PARTITIONS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        create_month_partition(cursor, month)
+        month = next_month(month)
+
+    cursor.execute('''
+        INSERT INTO conversations (id, user_id, role, content, mode, dialog_id, created_at)
+        SELECT id, user_id, role, content, mode, dialog_id, COALESCE(created_at, LOCALTIMESTAMP)
+        FROM conversations_legacy
+    ''')
+    cursor.execute('DROP TABLE conversations_legacy')
+    # Индекс на секционированной таблице создаётся и на всех будущих секциях
+    cursor.execute('''
+        CREATE INDEX idx_conversations_history
+        ON conversations (user_id, dialog_id, id DESC) INCLUDE (role, mode)
+    ''')
+
+    # Архив: одна строка на диалог и архивируемый период, сообщения — JSONB, который TOAST сжимает
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations_archive (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            dialog_id INTEGER NOT NULL,
+            first_id BIGINT NOT NULL,
+            last_id BIGINT NOT NULL,
+            first_at TIMESTAMP NOT NULL,
+            last_at TIMESTAMP NOT NULL,
+            message_count INTEGER NOT NULL,
+            messages JSONB NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_archive_dialog
+        ON conversations_archive (user_id, dialog_id, first_id)
+    ''')
+
+
+def _conversation_search(cursor):
+    # Полнотекстовый поиск: русская морфология плюс служебная лексема 'user:<id>'.
+    # Парсер не порождает лексем с двоеточием, поэтому запрос «слова & user:<id>»
+    # пересекает списки GIN-индекса внутри него, без обхода сообщений других пользователей.
+    # Генерируемый столбец пересчитывается при каждой вставке, секции наследуют его и индекс.
+    cursor.execute('''
+        ALTER TABLE conversations ADD COLUMN IF NOT EXISTS search_tsv tsvector
+        GENERATED ALWAYS AS (
+            to_tsvector('russian', content) || array_to_tsvector(ARRAY['user:' || user_id::text])
+        ) STORED
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_search ON conversations USING GIN (search_tsv)
+    ''')
+
+
+# (версия, описание, функция); новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'dialogs summary table', _dialogs_table),
+    (3, 'conversation history index', _history_index),
+    (4, 'rolling dialog summaries', _dialog_summaries),
+    (5, 'monthly partitions and archive for conversations', _partition_conversations),
+    (6, 'full-text search over conversations', _conversation_search),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def apply_migrations(conn):
+    """Применяет недостающие миграции, возвращает список применённых версий"""
+    cursor = conn.cursor()
+    # Обычный запуск: схема актуальна, хватает двух коротких чтений без DDL и блокировок
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+        current = cursor.fetchone()[0]
+        conn.commit()
+        if current >= LATEST_VERSION:
+            return []
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    applied = []
+    for version, name, migrate in MIGRATIONS:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATIONS_LOCK_ID,))
+        cursor.execute('SELECT 1 FROM schema_migrations WHERE version = %s', (version,))
+        if cursor.fetchone():
+            conn.commit()
+            continue
+        migrate(cursor)
+        cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+        conn.commit()
+        applied.append(version)
+    return applied
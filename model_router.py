@@ -0,0 +1,290 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from openrouter import OpenRouterBusy, MAX_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Пул моделей через запятую; первая — основная, остальные — резервные
+AI_MODELS = [m.strip() for m in os.getenv('AI_MODELS', 'openai/gpt-4o-mini').split(',') if m.strip()]
+# Сколько ждать первого токена (или полного ответа без потока), прежде чем считать попытку неудачной
+FIRST_TOKEN_TIMEOUT = float(os.getenv('LLM_FIRST_TOKEN_TIMEOUT', '20'))
+COMPLETE_TIMEOUT = float(os.getenv('LLM_COMPLETE_TIMEOUT', '45'))
+# Дублирующий запрос к резервной модели, если основная не ответила к перцентилю своей задержки
+HEDGE_ENABLED = os.getenv('LLM_HEDGE', '0') == '1'
+HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '0.95'))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', '5'))
+HEDGE_MIN_DELAY = 0.5
+# Circuit breaker: после стольких ошибок подряд модель выключается на время остывания
+CIRCUIT_FAILURES = int(os.getenv('LLM_CIRCUIT_FAILURES', '5'))
+CIRCUIT_COOLDOWN = float(os.getenv('LLM_CIRCUIT_COOLDOWN', '30'))
+# Оценка задержки модели, по которой ещё нет замеров
+LATENCY_PRIOR = 2.0
+LATENCY_WINDOW = 200
+ERROR_RATE_DECAY = 0.1
+# Доля ошибок забывается и со временем, а не только на успешных ответах: модель,
+# которую после сбоя перестали выбирать, через несколько минут снова получает запросы
+ERROR_RATE_HALF_LIFE = float(os.getenv('LLM_ERROR_RATE_HALF_LIFE', '60'))
+# Доля запросов, которые получает модель с более высоким приоритетом, оказавшаяся не первой
+# по оценке: без них её замеры после сбоя не обновляются и она не возвращается в работу
+PROBE_SHARE = float(os.getenv('LLM_PROBE_SHARE', '0.05'))
+
+_END = object()
+
+
+class ModelState:
+    """Наблюдаемая задержка, доля ошибок и состояние circuit breaker одной модели"""
+    def __init__(self, model: str, priority: int):
+        self.model = model
+        self.priority = priority
+        self.latencies = {'stream': deque(maxlen=LATENCY_WINDOW), 'complete': deque(maxlen=LATENCY_WINDOW)}
+        self._error_rate = 0.0
+        self._error_rate_at = time.monotonic()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.circuit_opens = 0
+
+    @property
+    def error_rate(self) -> float:
+        """Экспоненциально сглаженная доля ошибок, затухающая с периодом полураспада ERROR_RATE_HALF_LIFE"""
+        elapsed = time.monotonic() - self._error_rate_at
+        return self._error_rate * 0.5 ** (elapsed / ERROR_RATE_HALF_LIFE)
+
+    def _update_error_rate(self, failed: bool):
+        self._error_rate = self.error_rate * (1 - ERROR_RATE_DECAY) + (ERROR_RATE_DECAY if failed else 0.0)
+        self._error_rate_at = time.monotonic()
+
+    def percentile(self, kind: str, p: float):
+        values = sorted(self.latencies[kind])
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def available(self, now: float) -> bool:
+        if self.opened_at is None:
+            return True
+        # Полуоткрытое состояние: после остывания пропускаем один пробный запрос
+        return not self.probing and now - self.opened_at >= CIRCUIT_COOLDOWN
+
+    def score(self, kind: str) -> float:
+        """Чем меньше, тем предпочтительнее: медианная задержка с поправкой на ошибки"""
+        latency = self.percentile(kind, 0.5)
+        if latency is None:
+            latency = LATENCY_PRIOR
+        return latency * (1 + 4 * self.error_rate) + self.priority * 0.001
+
+    def record_success(self, kind: str, latency: float):
+        self.latencies[kind].append(latency)
+        self._update_error_rate(False)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._update_error_rate(True)
+        self.consecutive_failures += 1
+        if self.probing or self.consecutive_failures >= CIRCUIT_FAILURES:
+            if self.opened_at is None or self.probing:
+                self.circuit_opens += 1
+                logger.warning(f"Circuit opened for {self.model} after {self.consecutive_failures} failures")
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'error_rate': round(self.error_rate, 3),
+            'circuit_open': int(self.opened_at is not None),
+            'circuit_opens': self.circuit_opens,
+            'stream_p50': self.percentile('stream', 0.5) or 0.0,
+            'stream_p95': self.percentile('stream', 0.95) or 0.0,
+            'complete_p50': self.percentile('complete', 0.5) or 0.0,
+            'complete_p95': self.percentile('complete', 0.95) or 0.0
+        }
+
+
+class _Attempt:
+    """Запрос к одной модели в отдельной задаче; результат по кусочкам складывается в очередь"""
+    def __init__(self, state: ModelState, kind: str, chunks, ready: asyncio.Queue, hedged=False):
+        self.state = state
+        self.kind = kind
+        self.hedged = hedged
+        self.queue = asyncio.Queue()
+        self.error = None
+        self._ready = ready
+        self._task = asyncio.create_task(self._run(chunks))
+
+    async def _run(self, chunks):
+        started = time.monotonic()
+        first = True
+        timeout = FIRST_TOKEN_TIMEOUT if self.kind == 'stream' else COMPLETE_TIMEOUT
+        try:
+            async with asyncio.timeout(timeout) as deadline:
+                async for chunk in chunks:
+                    if first:
+                        first = False
+                        deadline.reschedule(None)
+                        self.state.record_success(self.kind, time.monotonic() - started)
+                        self._ready.put_nowait(self)
+                    self.queue.put_nowait(chunk)
+            if first:
+                self.state.record_success(self.kind, time.monotonic() - started)
+                self._ready.put_nowait(self)
+            self.queue.put_nowait(_END)
+        except asyncio.CancelledError:
+            if first:
+                # Проигравшая гонку модель отвечает не быстрее этого: учитываем как нижнюю оценку задержки
+                self.state.latencies[self.kind].append(time.monotonic() - started)
+                # Отменённая проба не должна навсегда оставить модель в полуоткрытом состоянии
+                self.state.probing = False
+            raise
+        except Exception as e:
+            if isinstance(e, TimeoutError):
+                e = TimeoutError(f"{self.state.model} не ответила за {timeout:.0f} с")
+            # Перегрузка нашего клиента — не вина модели
+            if not isinstance(e, OpenRouterBusy):
+                self.state.record_failure()
+            self.error = e
+            self.queue.put_nowait(e)
+            if first:
+                self._ready.put_nowait(self)
+
+    def cancel(self):
+        self._task.cancel()
+
+    async def chunks(self):
+        while True:
+            item = await self.queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class ModelRouter:
+    """Выбор модели из пула по наблюдаемой задержке и ошибкам.
+
+    - модели с открытым circuit breaker пропускаются до конца остывания;
+    - если модель не дала первый токен за FIRST_TOKEN_TIMEOUT или упала
+      до него, запрос повторяется на следующей модели;
+    - при LLM_HEDGE=1, если первый токен не пришёл к HEDGE_PERCENTILE
+      задержки выбранной модели, параллельно запускается резервная,
+      и ответ берётся у той, что успела первой;
+    - доля probe_share запросов уходит модели с высшим приоритетом, если
+      она не первая по оценке, — так её задержка и ошибки остаются свежими.
+    """
+    def __init__(self, client, models=None, hedging=HEDGE_ENABLED, probe_share=PROBE_SHARE):
+        self.client = client
+        self.models = {m: ModelState(m, i) for i, m in enumerate(models or AI_MODELS)}
+        self.hedging = hedging
+        self.probe_share = probe_share
+        self.probes = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    @property
+    def primary(self) -> str:
+        return next(iter(self.models))
+
+    def rank(self, kind: str) -> list:
+        now = time.monotonic()
+        available = [s for s in self.models.values() if s.available(now)]
+        if not available:
+            # Все выключены: пробуем ту, что выключилась раньше всех, чем не отвечать вовсе
+            available = [min(self.models.values(), key=lambda s: s.opened_at)]
+        ranked = sorted(available, key=lambda s: s.score(kind))
+        if len(ranked) > 1 and random.random() < self.probe_share:
+            preferred = min(ranked, key=lambda s: s.priority)
+            if preferred is not ranked[0]:
+                ranked.remove(preferred)
+                ranked.insert(0, preferred)
+                self.probes += 1
+        return ranked
+
+    def hedge_delay(self, state: ModelState, kind: str) -> float:
+        if len(state.latencies[kind]) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, state.percentile(kind, HEDGE_PERCENTILE))
+
+    async def _race(self, kind: str, request):
+        """Возвращает попытку, первой получившую ответ; request(model) — асинхронный итератор кусочков"""
+        candidates = self.rank(kind)
+        ready = asyncio.Queue()
+        attempts = []
+        winner = None
+
+        def launch(hedged=False):
+            state = candidates.pop(0)
+            if state.opened_at is not None:
+                state.probing = True
+            state.requests += 1
+            attempts.append(_Attempt(state, kind, request(state.model), ready, hedged))
+            return self.hedge_delay(state, kind) if self.hedging and candidates else None
+
+        hedge_delay = launch()
+        try:
+            while winner is None:
+                if all(a.error is not None for a in attempts):
+                    error = attempts[-1].error
+                    if isinstance(error, OpenRouterBusy) or not candidates:
+                        raise error
+                    self.fallbacks += 1
+                    logger.warning(f"{attempts[-1].state.model} failed ({error}), falling back")
+                    hedge_delay = launch()
+                    continue
+                try:
+                    attempt = await asyncio.wait_for(ready.get(), hedge_delay)
+                except asyncio.TimeoutError:
+                    self.hedges += 1
+                    launch(hedged=True)
+                    hedge_delay = None
+                    continue
+                if attempt.error is None:
+                    winner = attempt
+            if winner.hedged:
+                self.hedge_wins += 1
+            return winner
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+
+    async def stream(self, messages: list, on_model=None):
+        """Поток ответа от лучшей доступной модели; on_model(model) узнаёт, какая модель отвечает"""
+        winner = await self._race('stream', lambda model: self.client.stream(messages, model))
+        if on_model is not None:
+            on_model(winner.state.model)
+        try:
+            async for delta in winner.chunks():
+                yield delta
+        finally:
+            winner.cancel()
+
+    async def complete(self, messages: list, max_tokens: int = MAX_TOKENS, on_model=None) -> str:
+        async def request(model):
+            yield await self.client.complete(messages, model, max_tokens=max_tokens)
+
+        winner = await self._race('complete', request)
+        if on_model is not None:
+            on_model(winner.state.model)
+        return ''.join([chunk async for chunk in winner.chunks()])
+
+    def stats(self) -> dict:
+        return {
+            'probes': self.probes,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'fallbacks': self.fallbacks,
+            'models': {model: state.stats() for model, state in self.models.items()}
+        }
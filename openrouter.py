@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+import httpx
+import metrics
+
+# Переопределяется для нагрузочных стендов с локальной заглушкой
+OPENROUTER_URL = os.getenv('OPENROUTER_URL', "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_MAX_CONCURRENCY = int(os.getenv('OPENROUTER_MAX_CONCURRENCY', '64'))
+# Сколько запросов может ждать свободного слота, прежде чем клиент начнёт отказывать
+OPENROUTER_MAX_PENDING = int(os.getenv('OPENROUTER_MAX_PENDING', '256'))
+OPENROUTER_ACQUIRE_TIMEOUT = float(os.getenv('OPENROUTER_ACQUIRE_TIMEOUT', '30'))
+OPENROUTER_TIMEOUT = float(os.getenv('OPENROUTER_TIMEOUT', '60'))
+MAX_TOKENS = 15000
+NO_ANSWER = "Не удалось получить ответ от AI."
+
+
+class OpenRouterBusy(Exception):
+    """Клиент перегружен: все слоты заняты и очередь ожидания заполнена"""
+
+
+class OpenRouterClient:
+    """Общий асинхронный клиент OpenRouter с пулом keep-alive соединений"""
+    def __init__(self, max_concurrency=OPENROUTER_MAX_CONCURRENCY, max_pending=OPENROUTER_MAX_PENDING,
+                 acquire_timeout=OPENROUTER_ACQUIRE_TIMEOUT, timeout=OPENROUTER_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.acquire_timeout = acquire_timeout
+        self.timeout = timeout
+        self._client = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = 0
+        self._waiting = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @property
+    def saturated(self) -> bool:
+        return self._waiting >= self.max_pending
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            # Ключ читается при первом запросе, когда .env уже загружен
+            api_key = os.getenv('OPEN_ROUTER_API_KEY')
+            self._client = httpx.AsyncClient(
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                timeout=httpx.Timeout(self.timeout, connect=10),
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                    keepalive_expiry=60
+                )
+            )
+        return self._client
+
+    @asynccontextmanager
+    async def _slot(self):
+        """Занимает слот конкурентности или сообщает о перегрузке через OpenRouterBusy"""
+        if self.saturated:
+            raise OpenRouterBusy("Слишком много запросов к AI, попробуйте позже")
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise OpenRouterBusy("AI сейчас перегружен, попробуйте позже")
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+
+    async def complete(self, messages: list, model: str, max_tokens: int = MAX_TOKENS) -> str:
+        """Возвращает полный ответ модели"""
+        data = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens
+        }
+        async with self._slot():
+            with metrics.measure('openrouter', 'complete'):
+                response = await self._get_client().post(OPENROUTER_URL, json=data)
+                response.raise_for_status()
+                result = response.json()
+        metrics.record_tokens(model, result.get('usage'))
+        if 'choices' in result and len(result['choices']) > 0:
+            return result['choices'][0]['message']['content']
+        return NO_ANSWER
+
+    async def stream(self, messages: list, model: str):
+        """Читает SSE-поток OpenRouter и отдаёт текст ответа по кусочкам"""
+        data = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": MAX_TOKENS,
+            "stream": True
+        }
+        async with self._slot():
+            with metrics.measure('openrouter', 'stream'):
+                started = time.perf_counter()
+                first_token = True
+                async with self._get_client().stream("POST", OPENROUTER_URL, json=data) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        # Строки-комментарии (": OPENROUTER PROCESSING") и пустые строки пропускаем
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            break
+                        chunk = json.loads(payload)
+                        if 'error' in chunk:
+                            raise RuntimeError(chunk['error'].get('message', 'ошибка OpenRouter'))
+                        # usage приходит в последнем чанке
+                        metrics.record_tokens(model, chunk.get('usage'))
+                        choices = chunk.get('choices') or []
+                        if choices:
+                            delta = choices[0].get('delta', {}).get('content')
+                            if delta:
+                                if first_token:
+                                    metrics.record_first_token(model, time.perf_counter() - started)
+                                    first_token = False
+                                yield delta
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Глобальный клиент OpenRouter
+openrouter = OpenRouterClient()
@@ -0,0 +1,230 @@
+import os
+import re
+import math
+import time
+import zlib
+import hashlib
+import threading
+from itertools import chain
+from collections import Counter, OrderedDict
+from context_builder import estimate_tokens
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE', '0') == '1'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '2000'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', str(24 * 3600)))
+# Порог косинусной близости для приблизительного совпадения
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0.93'))
+EMBEDDING_DIM = 2048
+
+# Слова, которые не меняют смысла самостоятельного вопроса
+STOP_WORDS = {
+    'пожалуйста', 'плиз', 'что', 'такое', 'мне', 'можешь', 'можно', 'ну', 'а', 'и', 'в', 'на',
+    'о', 'об', 'про', 'по', 'с', 'для', 'как', 'это'
+}
+
+
+def fold_text(text: str) -> str:
+    """Регистр и пробелы без значения; знаки остаются — «2+2» и «2*2» разные вопросы"""
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+
+def normalize_text(text: str) -> str:
+    return ' '.join(re.sub(r'[^\w\s]', ' ', fold_text(text)).split())
+
+
+def signature(text: str) -> tuple:
+    """Числа и значимые символы вопроса по порядку.
+
+    Приблизительное совпадение допускается только при одинаковой сигнатуре:
+    эмбеддинг их не видит, а «x^2+2x=0» и «x^2-2x=0» — разные задачи.
+    Знаки препинания предложения в сигнатуру не входят.
+    """
+    return tuple(re.findall(r'\d+|[^\w\s.,!?…;:"«»\']', text))
+
+
+def _stem_index(word: str) -> int:
+    return zlib.crc32(f'w:{word[:6]}'.encode('utf-8')) % EMBEDDING_DIM
+
+
+def stems(text: str) -> frozenset:
+    """Индексы основ слов в эмбеддинге — ключи инвертированного индекса кэша"""
+    return frozenset(_stem_index(word) for word in normalize_text(text).split() if word not in STOP_WORDS)
+
+
+def embed(text: str) -> dict:
+    """Локальный эмбеддинг: хешированные основы слов и символьные триграммы, L2-нормированный.
+
+    Основа слова — первые 6 букв, этого хватает, чтобы «объясни» и «объясните»
+    совпали, а «ДНК» и «РНК» — нет.
+    """
+    vector = {}
+    for word in normalize_text(text).split():
+        if word in STOP_WORDS:
+            continue
+        index = _stem_index(word)
+        vector[index] = vector.get(index, 0.0) + 2.0
+        padded = f' {word} '
+        for i in range(len(padded) - 2):
+            index = zlib.crc32(padded[i:i + 3].encode('utf-8')) % EMBEDDING_DIM
+            vector[index] = vector.get(index, 0.0) + 0.3
+    norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+    return {k: v / norm for k, v in vector.items()}
+
+
+def cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+class CacheEntry:
+    def __init__(self, response, expires_at, prompt_tokens, latency, scope, signature, vector, stems):
+        self.response = response
+        self.expires_at = expires_at
+        self.prompt_tokens = prompt_tokens
+        self.latency = latency
+        self.scope = scope
+        self.signature = signature
+        self.vector = vector
+        self.stems = stems
+
+
+class ResponseCache:
+    """Кэш ответов модели с точным и приблизительным уровнями.
+
+    Точный уровень — по хешу модели, системного промпта и нормализованного
+    списка сообщений. Приблизительный — по близости локальных эмбеддингов,
+    только для самостоятельных вопросов без истории. Диалоги с историей не
+    кэшируются: ответ в них зависит от контекста.
+
+    Чтобы не сравнивать вопрос со всем кэшем, записи разложены по
+    инвертированному индексу (scope, основа слова) -> ключи. Основы весят в
+    эмбеддинге намного больше триграмм, поэтому близость выше порога возможна
+    только у записей, разделяющих с вопросом хотя бы половину основ: косинус
+    считается лишь для них.
+    """
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 similarity=RESPONSE_CACHE_SIMILARITY, enabled=RESPONSE_CACHE_ENABLED):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity = similarity
+        self.enabled = enabled
+        self.exact_hits = 0
+        self.approx_hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_seconds = 0.0
+        self._entries = OrderedDict()  # ключ -> CacheEntry
+        self._index = {}  # (scope, основа) -> множество ключей
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_cacheable(messages: list) -> bool:
+        """Только системный промпт и один вопрос пользователя — без истории и краткого содержания"""
+        return len(messages) == 2 and messages[0]['role'] == 'system' and messages[1]['role'] == 'user'
+
+    @staticmethod
+    def _key(messages: list, model: str) -> str:
+        parts = [model] + [f"{m['role']}:{fold_text(m['content'])}" for m in messages]
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _scope(messages: list, model: str) -> str:
+        """Приблизительное совпадение ищется только среди записей с той же моделью и промптом"""
+        return hashlib.sha256(f"{model}\x1f{messages[0]['content']}".encode('utf-8')).hexdigest()
+
+    def lookup(self, messages: list, models):
+        """Возвращает сохранённый ответ любой из моделей models (в порядке предпочтения) или None"""
+        if not self.enabled or not self.is_cacheable(messages):
+            return None
+        if isinstance(models, str):
+            models = [models]
+        now = time.monotonic()
+        with self._lock:
+            for model in models:
+                key = self._key(messages, model)
+                entry = self._entries.get(key)
+                if entry is not None and entry.expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.exact_hits += 1
+                    return self._hit(entry)
+
+        # Эмбеддинг считается без блокировки, под ней — только отбор кандидатов по индексу
+        question = messages[1]['content']
+        vector = embed(question)
+        question_stems = stems(question)
+        question_signature = signature(question)
+        scopes = [self._scope(messages, model) for model in models]
+        with self._lock:
+            shared = Counter(chain.from_iterable(
+                self._index.get((scope, stem), ()) for scope in scopes for stem in question_stems
+            ))
+            needed = (len(question_stems) + 1) // 2
+            best, best_score = None, self.similarity
+            for candidate, count in shared.items():
+                if count < needed:
+                    continue
+                entry = self._entries[candidate]
+                if entry.expires_at < now:
+                    continue
+                # Вопросы с разными числами или операторами считаем разными, как бы похожи ни были слова
+                if entry.signature != question_signature:
+                    continue
+                score = cosine(vector, entry.vector)
+                if score >= best_score:
+                    best, best_score = entry, score
+            if best is not None:
+                self.approx_hits += 1
+                return self._hit(best)
+            self.misses += 1
+            return None
+
+    def _hit(self, entry):
+        self.saved_tokens += entry.prompt_tokens + estimate_tokens(entry.response)
+        self.saved_seconds += entry.latency
+        return entry.response
+
+    def store(self, messages: list, model: str, response: str, latency: float = 0.0):
+        if not self.enabled or not self.is_cacheable(messages):
+            return
+        question = messages[1]['content']
+        entry = CacheEntry(
+            response=response,
+            expires_at=time.monotonic() + self.ttl,
+            prompt_tokens=sum(estimate_tokens(m['content']) for m in messages),
+            latency=latency,
+            scope=self._scope(messages, model),
+            signature=signature(question),
+            vector=embed(question),
+            stems=stems(question)
+        )
+        key = self._key(messages, model)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._unindex(key, old)
+            self._entries[key] = entry
+            for stem in entry.stems:
+                self._index.setdefault((entry.scope, stem), set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._unindex(*self._entries.popitem(last=False))
+
+    def _unindex(self, key, entry):
+        for stem in entry.stems:
+            keys = self._index.get((entry.scope, stem))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[(entry.scope, stem)]
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.approx_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'exact_hits': self.exact_hits,
+            'approx_hits': self.approx_hits,
+            'misses': self.misses,
+            'hit_rate': (self.exact_hits + self.approx_hits) / lookups if lookups else 0.0,
+            'saved_tokens': self.saved_tokens,
+            'saved_seconds': round(self.saved_seconds, 2)
+        }
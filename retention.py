@@ -0,0 +1,194 @@
+"""Обслуживание таблицы conversations: секции наперёд, архивирование старых месяцев и лимит длины диалога.
+
+Секции старше CONVERSATION_RETENTION_DAYS целиком переносятся в
+conversations_archive (одна строка JSONB на диалог) и удаляются через
+DETACH + DROP: ни построчного DELETE, ни раздувания таблицы и индексов.
+Диалоги длиннее DIALOG_MAX_MESSAGES обрезаются до этого числа последних
+сообщений, обрезанное тоже уходит в архив.
+
+По умолчанию обе границы выключены (0): архивирование и обрезка удаляют
+сообщения из conversations, поэтому включаются оператором явно. Секции
+наперёд создаются всегда.
+
+Чтения истории и поиск не ограничены по created_at (начало диалога
+неизвестно) и проходят по индексу каждой секции. Без архивирования секций
+становится на одну больше каждый месяц; на 36 секциях подготовленный запрос
+истории медленнее примерно на 0,1 мс.
+"""
+import os
+import re
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from migrations import PARTITIONS_AHEAD, next_month, create_month_partition
+
+logger = logging.getLogger(__name__)
+
+# 0 — не архивировать по возрасту
+CONVERSATION_RETENTION_DAYS = int(os.getenv('CONVERSATION_RETENTION_DAYS', '0'))
+# 0 — без ограничения длины диалога
+DIALOG_MAX_MESSAGES = int(os.getenv('DIALOG_MAX_MESSAGES', '0'))
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', str(6 * 3600)))
+# Сколько переполненных диалогов обрезать за один проход
+TRIM_BATCH = 500
+# Несколько воркеров не выполняют обслуживание одновременно
+RETENTION_LOCK_ID = 834_271_002
+
+_PARTITION_RE = re.compile(r'^conversations_p(\d{4})(\d{2})$')
+
+_ARCHIVE_COLUMNS = '''
+    user_id, dialog_id, MIN(id), MAX(id), MIN(created_at), MAX(created_at), COUNT(*),
+    jsonb_agg(jsonb_build_object(
+        'id', id, 'role', role, 'content', content, 'mode', mode, 'created_at', created_at
+    ) ORDER BY id)
+'''
+
+
+def months_ahead(now: datetime) -> list:
+    """Месяцы, секции которых должны существовать: текущий и PARTITIONS_AHEAD вперёд"""
+    months = [now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)]
+    for _ in range(PARTITIONS_AHEAD):
+        months.append(next_month(months[-1]))
+    return months
+
+
+def default_months(cursor) -> list:
+    """Месяцы, строки которых оказались в секции по умолчанию, — им тоже нужны свои секции"""
+    cursor.execute("SELECT DISTINCT date_trunc('month', created_at) FROM conversations_default")
+    return [month for (month,) in cursor.fetchall()]
+
+
+def expired_partitions(cursor, now: datetime, retention_days: int) -> list:
+    """Месячные секции, целиком лежащие раньше now - retention_days"""
+    cutoff = now - timedelta(days=retention_days)
+    cursor.execute('''
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'conversations'::regclass
+    ''')
+    expired = []
+    for (name,) in cursor.fetchall():
+        match = _PARTITION_RE.match(name)
+        if match and next_month(datetime(int(match.group(1)), int(match.group(2)), 1)) <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+def archive_partition(cursor, name: str) -> int:
+    """Переносит секцию в архив и отсоединяет её; возвращает число перенесённых сообщений"""
+    cursor.execute(f'''
+        WITH moved AS (
+            INSERT INTO conversations_archive
+                (user_id, dialog_id, first_id, last_id, first_at, last_at, message_count, messages)
+            SELECT {_ARCHIVE_COLUMNS}
+            FROM {name}
+            GROUP BY user_id, dialog_id
+            RETURNING user_id, dialog_id, message_count
+        ), counted AS (
+            UPDATE dialogs d SET message_count = GREATEST(d.message_count - m.message_count, 0)
+            FROM moved m
+            WHERE d.user_id = m.user_id AND d.dialog_id = m.dialog_id
+        )
+        SELECT COALESCE(SUM(message_count), 0) FROM moved
+    ''')
+    moved = cursor.fetchone()[0]
+    cursor.execute(f'ALTER TABLE conversations DETACH PARTITION {name}')
+    cursor.execute(f'DROP TABLE {name}')
+    return moved
+
+
+def trim_dialogs(cursor, max_messages: int) -> int:
+    """Оставляет в переполненных диалогах max_messages последних сообщений; возвращает число перенесённых"""
+    cursor.execute('''
+        SELECT user_id, dialog_id FROM dialogs WHERE message_count > %s LIMIT %s
+    ''', (max_messages, TRIM_BATCH))
+    moved = 0
+    for user_id, dialog_id in cursor.fetchall():
+        cursor.execute(f'''
+            WITH overflow AS (
+                SELECT id, created_at FROM conversations
+                WHERE user_id = %(user_id)s AND dialog_id = %(dialog_id)s
+                ORDER BY id DESC
+                OFFSET %(keep)s
+            ), deleted AS (
+                DELETE FROM conversations c USING overflow o
+                WHERE c.id = o.id AND c.created_at = o.created_at
+                RETURNING c.*
+            ), moved AS (
+                INSERT INTO conversations_archive
+                    (user_id, dialog_id, first_id, last_id, first_at, last_at, message_count, messages)
+                SELECT {_ARCHIVE_COLUMNS}
+                FROM deleted
+                GROUP BY user_id, dialog_id
+                RETURNING message_count
+            ), total AS (
+                SELECT COALESCE(SUM(message_count), 0) AS moved FROM moved
+            ), counted AS (
+                -- Вычитаем, а не присваиваем: сообщения, записанные во время прохода, не теряются из счётчика
+                UPDATE dialogs SET message_count = GREATEST(message_count - total.moved, 0)
+                FROM total
+                WHERE user_id = %(user_id)s AND dialog_id = %(dialog_id)s
+            )
+            SELECT moved FROM total
+        ''', {'user_id': user_id, 'dialog_id': dialog_id, 'keep': max_messages})
+        moved += cursor.fetchone()[0]
+    return moved
+
+
+def _run_step(conn, stats, name, func, *args):
+    """Шаг обслуживания в своей транзакции: сбой шага откатывает только его и не мешает остальным"""
+    try:
+        result = func(conn.cursor(), *args)
+        conn.commit()
+        return result
+    except Exception as e:
+        conn.rollback()
+        stats['failed_steps'] += 1
+        logger.error(f"Conversation retention step {name} failed: {e}")
+        return None
+
+
+def run_retention(conn, retention_days=CONVERSATION_RETENTION_DAYS, max_messages=DIALOG_MAX_MESSAGES) -> dict:
+    """Один проход обслуживания; если его уже выполняет другой процесс, ничего не делает"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s)', (RETENTION_LOCK_ID,))
+    if not cursor.fetchone()[0]:
+        conn.commit()
+        return {'skipped': 1}
+    try:
+        cursor.execute('SELECT LOCALTIMESTAMP')
+        now = cursor.fetchone()[0]
+        conn.commit()
+        stats = {'partitions_checked': 0, 'moved_from_default': 0, 'archived_partitions': 0,
+                 'archived_messages': 0, 'trimmed_messages': 0, 'failed_steps': 0}
+        months = set(months_ahead(now))
+        months.update(_run_step(conn, stats, 'default partition', default_months) or [])
+        for month in sorted(months):
+            moved = _run_step(conn, stats, f'partition {month:%Y-%m}', create_month_partition, month)
+            if moved is not None:
+                stats['partitions_checked'] += 1
+                stats['moved_from_default'] += moved
+        if retention_days > 0:
+            # Каждая секция — своя транзакция: прерванный проход не оставит полуперенесённых данных
+            for name in _run_step(conn, stats, 'expired partitions', expired_partitions, now, retention_days) or []:
+                moved = _run_step(conn, stats, f'archive {name}', archive_partition, name)
+                if moved is not None:
+                    stats['archived_messages'] += moved
+                    stats['archived_partitions'] += 1
+        if max_messages > 0:
+            stats['trimmed_messages'] = _run_step(conn, stats, 'trim dialogs', trim_dialogs, max_messages) or 0
+        return stats
+    finally:
+        conn.rollback()
+        cursor.execute('SELECT pg_advisory_unlock(%s)', (RETENTION_LOCK_ID,))
+        conn.commit()
+
+
+async def retention_loop(db, interval=RETENTION_INTERVAL):
+    """Фоновая задача: обслуживание при старте и затем каждые interval секунд"""
+    while True:
+        try:
+            stats = await db.run_retention()
+            logger.info(f"Conversation retention: {stats}")
+        except Exception as e:
+            logger.error(f"Conversation retention failed: {e}")
+        await asyncio.sleep(interval)
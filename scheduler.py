@@ -0,0 +1,245 @@
+import os
+import time
+import asyncio
+import contextvars
+from collections import deque
+
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))
+# Ограничение частоты запросов к OpenRouter: запросов в секунду и размер всплеска; 0 — без ограничения
+LLM_RATE_PER_SEC = float(os.getenv('LLM_RATE_PER_SEC', '10'))
+LLM_RATE_BURST = int(os.getenv('LLM_RATE_BURST', '20'))
+
+# Допуск новых запросов: не больше LLM_MAX_QUEUE ожидающих и не дольше LLM_MAX_WAIT секунд оценки ожидания
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', '500'))
+LLM_MAX_WAIT = float(os.getenv('LLM_MAX_WAIT', '120'))
+# Оценка длительности одного запроса, пока нет замеров, и вес нового замера в скользящем среднем
+SERVICE_TIME_PRIOR = 5.0
+SERVICE_TIME_DECAY = 0.2
+
+# Результат задачи, которую заменило более новое сообщение того же пользователя
+COALESCED = object()
+
+
+class Admission:
+    """Решение о приёме запроса: принят ли, место в очереди и оценка ожидания в секундах.
+
+    Принятый запрос держит место в очереди до submit(); если до него дело
+    не дошло, место освобождается release().
+    """
+    def __init__(self, accepted: bool, position: int, wait: float, scheduler=None, user_id=None):
+        self.accepted = accepted
+        self.position = position
+        self.wait = wait
+        self._scheduler = scheduler
+        self._user_id = user_id
+
+    def release(self):
+        """Освобождает зарезервированное место; повторный вызов ничего не делает"""
+        if self._scheduler is not None:
+            self._scheduler._release(self._user_id)
+            self._scheduler = None
+
+
+class TokenBucket:
+    """Token bucket: не больше rate запросов в секунду со всплеском до capacity"""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Job:
+    def __init__(self, user_id, factory, future):
+        self.user_id = user_id
+        self.factory = factory
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        # Задача выполняется в контексте отправителя (трассировка обновления и т.п.)
+        self.context = contextvars.copy_context()
+
+
+class LLMScheduler:
+    """Планировщик вызовов модели.
+
+    - у пользователя выполняется не больше одного запроса; сообщения, пришедшие
+      за это время, схлопываются в один следующий запрос;
+    - общее число одновременных запросов ограничено max_concurrency;
+    - частота запусков ограничена token bucket;
+    - пользователи обслуживаются по кругу, так что один активный
+      пользователь не может занять всю очередь;
+    - admit() до постановки в очередь оценивает ожидание по глубине
+      очереди и недавней длительности запросов и отказывает, если очередь
+      переполнена или ждать пришлось бы дольше max_wait; принятый запрос
+      сразу занимает место, так что всплеск сообщений не проскочит
+      admit() целиком, пока обработчики ещё ходят в базу.
+    """
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, rate=LLM_RATE_PER_SEC, burst=LLM_RATE_BURST,
+                 max_queue=LLM_MAX_QUEUE, max_wait=LLM_MAX_WAIT):
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.service_time = SERVICE_TIME_PRIOR
+        self.coalesced = 0
+        self.started = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=1000)
+        self._pending = {}  # user_id -> Job, ещё не запущенная
+        self._reserved = {}  # user_id -> принятые admit(), ещё не дошедшие до submit()
+        self._order = deque()  # очередь пользователей для обхода по кругу
+        self._running_users = set()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._tasks = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def waiting(self) -> int:
+        """Ожидающие пользователи вместе с принятыми, но ещё не поставленными в очередь"""
+        return len(self._pending) + sum(1 for user_id in self._reserved if user_id not in self._pending)
+
+    @property
+    def running(self) -> int:
+        return len(self._running_users)
+
+    def position(self, user_id) -> int:
+        """Место, которое займёт новый запрос пользователя среди ожидающих (с 1)"""
+        if user_id in self._pending:
+            # Новое сообщение заменит ожидающее и займёт его место в круге
+            waiting = [u for u in self._order if u in self._pending]
+            return waiting.index(user_id) + 1
+        if user_id in self._reserved:
+            # Заменит свой же принятый запрос, место уже учтено
+            return self.waiting
+        return self.waiting + 1
+
+    def estimate_wait(self, user_id, position: int) -> float:
+        ahead = position - 1
+        free = self.max_concurrency - self.running
+        wait = 0.0
+        if ahead >= free:
+            # Каждые max_concurrency запросов впереди — ещё одна средняя длительность запроса
+            wait = ((ahead - free) // self.max_concurrency + 1) * self.service_time
+        if user_id in self._running_users:
+            wait = max(wait, self.service_time)
+        if self.bucket.rate > 0:
+            wait = max(wait, (ahead + 1 - self.bucket.tokens) / self.bucket.rate)
+        return wait
+
+    def admit(self, user_id) -> Admission:
+        """Решает, принимать ли новый запрос пользователя; принятый резервирует место до submit()"""
+        position = self.position(user_id)
+        wait = self.estimate_wait(user_id, position)
+        replaces = user_id in self._pending or user_id in self._reserved
+        if (not replaces and self.waiting >= self.max_queue) or wait > self.max_wait:
+            self.rejected += 1
+            return Admission(False, position, wait)
+        self._reserved[user_id] = self._reserved.get(user_id, 0) + 1
+        return Admission(True, position, wait, self, user_id)
+
+    def _release(self, user_id):
+        count = self._reserved.get(user_id, 0) - 1
+        if count > 0:
+            self._reserved[user_id] = count
+        else:
+            self._reserved.pop(user_id, None)
+
+    async def submit(self, user_id, factory, admission: Admission = None):
+        """Ставит factory() в очередь пользователя и возвращает её результат.
+
+        Если до запуска пришло более новое сообщение того же пользователя,
+        возвращает COALESCED — ответ будет дан уже на новое сообщение.
+        Место, зарезервированное admission, переходит к поставленной задаче.
+        """
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        job = Job(user_id, factory, asyncio.get_running_loop().create_future())
+        previous = self._pending.get(user_id)
+        if previous is not None:
+            if not previous.future.done():
+                previous.future.set_result(COALESCED)
+            self.coalesced += 1
+        else:
+            self._order.append(user_id)
+        self._pending[user_id] = job
+        if admission is not None:
+            admission.release()
+        self._wakeup.set()
+        return await job.future
+
+    def _next_job(self):
+        for _ in range(len(self._order)):
+            user_id = self._order.popleft()
+            if user_id in self._running_users:
+                # Дождётся завершения текущего запроса, но место в круге сохраняет
+                self._order.append(user_id)
+                continue
+            job = self._pending.pop(user_id)
+            if job.future.done():
+                continue
+            return job
+        return None
+
+    async def _dispatch(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.running < self.max_concurrency:
+                job = self._next_job()
+                if job is None:
+                    break
+                await self.bucket.acquire()
+                if job.future.done():
+                    continue
+                self._running_users.add(job.user_id)
+                self.started += 1
+                self.wait_times.append(time.monotonic() - job.enqueued_at)
+                task = asyncio.create_task(self._execute(job), context=job.context)
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job):
+        started = time.monotonic()
+        try:
+            result = await job.factory()
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            # Упавшие по таймауту запросы тоже занимали слот — учитываем и их
+            self.service_time += (time.monotonic() - started - self.service_time) * SERVICE_TIME_DECAY
+            self._running_users.discard(job.user_id)
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_times)
+        return {
+            'queue_depth': self.queue_depth,
+            'reserved': sum(self._reserved.values()),
+            'running': self.running,
+            'started': self.started,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+            'service_time': self.service_time,
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0
+        }
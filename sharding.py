@@ -0,0 +1,179 @@
+"""Шардирование обновлений по user_id между несколькими воркерами бота.
+
+Каждый пользователь закреплён за одним воркером, поэтому кэши сессий,
+буфер записи и очередь запросов к модели внутри воркера остаются
+согласованными. Маршрутизатор принимает webhook Telegram и пересылает
+обновление воркеру, отвечающему за пользователя; воркеры работают в
+режиме webhook с WEBHOOK_REGISTER=0 и могут жить на разных хостах.
+"""
+import os
+import hmac
+import signal
+import asyncio
+import logging
+import aiohttp
+from aiohttp import web
+from telegram import Bot, Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+FORWARD_TIMEOUT = float(os.getenv('ROUTER_FORWARD_TIMEOUT', '10'))
+
+
+def update_user_id(data: dict):
+    """user_id автора обновления из сырого JSON или None для обновлений без пользователя"""
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+        chat = value.get('chat')
+        if chat:
+            return chat['id']
+    return None
+
+
+def shard_for(user_id, shards: int) -> int:
+    if user_id is None or shards <= 1:
+        return 0
+    return user_id % shards
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик обновлений Application: обновления одного пользователя — строго
+    по очереди, разных пользователей — параллельно, не больше workers сразу.
+
+    Шардирование закрепляет пользователя за воркером, а этот класс сохраняет
+    порядок его обновлений внутри воркера: «Новый диалог» и следующий за ним
+    вопрос не обгоняют друг друга. Обновление, ждущее предыдущего от того же
+    пользователя, слот workers не занимает.
+    """
+    # Семафор базового класса не ограничивает: лимит workers применяется после очереди пользователя
+    UNLIMITED = 2 ** 31 - 1
+
+    def __init__(self, workers: int):
+        super().__init__(self.UNLIMITED)
+        self.workers = workers
+        self._slots = asyncio.Semaphore(workers)
+        self._users = {}  # user_id -> [asyncio.Lock, обновлений в очереди]
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None) or getattr(update, 'effective_chat', None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._users.get(user.id)
+        if entry is None:
+            entry = self._users[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock пропускает ожидающих в порядке прихода — порядке update_id
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> dict:
+        return {'users': len(self._users), 'queued': sum(count for _, count in self._users.values())}
+
+
+def create_router_app(worker_urls: list, secret_token: str, path: str = 'telegram') -> web.Application:
+    """aiohttp-приложение, пересылающее обновления воркерам по shard_for(user_id).
+
+    Telegram получает 200 только после того, как воркер принял обновление,
+    иначе 503 — и Telegram повторит доставку.
+    """
+    session = None
+
+    async def on_startup(app):
+        nonlocal session
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT))
+
+    async def on_cleanup(app):
+        await session.close()
+
+    async def handle_update(request: web.Request) -> web.Response:
+        received = request.headers.get(SECRET_HEADER, '')
+        if not secret_token or not hmac.compare_digest(received, secret_token):
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        worker_url = worker_urls[shard_for(update_user_id(data), len(worker_urls))]
+        try:
+            async with session.post(worker_url, data=body, headers={
+                SECRET_HEADER: secret_token, 'Content-Type': 'application/json'
+            }) as response:
+                return web.Response(status=200 if response.status == 200 else 503)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Forwarding update to {worker_url} failed: {e}")
+            return web.Response(status=503)
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({'ok': True, 'workers': len(worker_urls)})
+
+    app = web.Application()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post(f'/{path}', handle_update)
+    app.router.add_get('/healthz', health)
+    return app
+
+
+def make_bot(token: str) -> Bot:
+    """Bot для служебных вызовов вне Application, с тем же адресом Bot API, что и у воркеров"""
+    return Bot(token, base_url=os.getenv('TELEGRAM_API_BASE_URL') or 'https://api.telegram.org/bot')
+
+
+async def register_webhook(token: str, url: str, path: str, secret_token: str):
+    async with make_bot(token) as bot:
+        await bot.set_webhook(
+            url=f"{url.rstrip('/')}/{path}",
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=100
+        )
+
+
+async def run_router(token: str):
+    """Регистрирует webhook и пересылает обновления воркерам из WORKER_URLS до SIGINT/SIGTERM"""
+    url = os.getenv('WEBHOOK_URL')
+    secret_token = os.getenv('WEBHOOK_SECRET')
+    path = os.getenv('WEBHOOK_PATH', 'telegram')
+    listen = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    port = int(os.getenv('PORT', os.getenv('WEBHOOK_PORT', '8443')))
+    # Адреса webhook воркеров через запятую, порядок задаёт номер шарда
+    worker_urls = [u.strip() for u in os.getenv('WORKER_URLS', '').split(',') if u.strip()]
+    if not secret_token or not url:
+        raise ValueError("Для маршрутизатора нужны переменные окружения WEBHOOK_URL и WEBHOOK_SECRET")
+    if not worker_urls:
+        raise ValueError("Для маршрутизатора нужна переменная окружения WORKER_URLS")
+
+    await register_webhook(token, url, path, secret_token)
+    runner = web.AppRunner(create_router_app(worker_urls, secret_token, path), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    logger.info(f"Router listening on {listen}:{port}/{path}, {len(worker_urls)} workers")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
@@ -1,57 +1,85 @@
 import os
-import requests
+import asyncio
 import logging
+import httpx
+from cache import TTLCache
+from metrics import measure
 
 logger = logging.getLogger(__name__)
 
+SUPABASE_TIMEOUT = float(os.getenv('SUPABASE_TIMEOUT', '5'))
+SUPABASE_RETRIES = int(os.getenv('SUPABASE_RETRIES', '2'))
+SUPABASE_MAX_CONNECTIONS = int(os.getenv('SUPABASE_MAX_CONNECTIONS', '20'))
+CREDENTIALS_CACHE_TTL = float(os.getenv('CREDENTIALS_CACHE_TTL', '60'))
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 502, 503, 504}
+
+_MISSING = object()
+
+
 class SupabaseHTTPClient:
     def __init__(self):
-        self.url = os.getenv('SUPABASE_URL')
-        self.key = os.getenv('SUPABASE_KEY')
-        if not self.url or not self.key:
-            raise ValueError("Supabase URL and KEY must be set in environment variables")
-        
-        self.headers = {
-            'apikey': self.key,
-            'Authorization': f'Bearer {self.key}',
-            'Content-Type': 'application/json',
-            'Prefer': 'return=representation'
-        }
-        self.base_url = f"{self.url}/rest/v1"
-    
-    def _make_request(self, method, endpoint, data=None):
-        """Универсальный метод для HTTP запросов"""
-        url = f"{self.base_url}/{endpoint}"
-        try:
-            if method.upper() == 'GET':
-                response = requests.get(url, headers=self.headers, params=data)
-            elif method.upper() == 'POST':
-                response = requests.post(url, headers=self.headers, json=data)
-            elif method.upper() == 'PUT':
-                response = requests.put(url, headers=self.headers, json=data)
-            elif method.upper() == 'PATCH':
-                response = requests.patch(url, headers=self.headers, json=data)
-            elif method.upper() == 'DELETE':
-                response = requests.delete(url, headers=self.headers)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-            
-            response.raise_for_status()
-            return response.json() if response.content else None
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"HTTP {method} request failed: {e}")
-            raise
-    
-    def save_website_credentials(self, telegram_id: int, login: str, password: str, subscription_type: str = 'free'):
-        """Сохраняет логин и пароль в Supabase"""
+        # Адрес и ключ читаются при первом запросе: модуль импортируется и без настроенного окружения
+        self.credentials_cache = TTLCache(maxsize=10000, ttl=CREDENTIALS_CACHE_TTL)
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            url = os.getenv('SUPABASE_URL')
+            key = os.getenv('SUPABASE_KEY')
+            if not url or not key:
+                raise ValueError("Supabase URL and KEY must be set in environment variables")
+            self._client = httpx.AsyncClient(
+                base_url=f"{url}/rest/v1",
+                headers={
+                    'apikey': key,
+                    'Authorization': f'Bearer {key}',
+                    'Content-Type': 'application/json',
+                    'Prefer': 'return=representation'
+                },
+                timeout=SUPABASE_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=SUPABASE_MAX_CONNECTIONS,
+                    max_keepalive_connections=SUPABASE_MAX_CONNECTIONS
+                )
+            )
+        return self._client
+
+    async def _make_request(self, method, endpoint, data=None, params=None, headers=None):
+        """Универсальный метод для HTTP запросов с таймаутом и повторами"""
+        method = method.upper()
+        if method not in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+            raise ValueError(f"Unsupported HTTP method: {method}")
+        if method == 'GET':
+            params, data = data, None
+
+        with measure('supabase', f"{method} {endpoint.split('?')[0]}"):
+            return await self._request_with_retries(method, endpoint, data, params, headers)
+
+    async def _request_with_retries(self, method, endpoint, data, params, headers):
+        for attempt in range(SUPABASE_RETRIES + 1):
+            try:
+                response = await self._get_client().request(
+                    method, f"/{endpoint}", params=params, json=data, headers=headers
+                )
+                if response.status_code in RETRY_STATUSES and attempt < SUPABASE_RETRIES:
+                    await asyncio.sleep(0.2 * 2 ** attempt)
+                    continue
+                response.raise_for_status()
+                return response.json() if response.content else None
+            except httpx.TransportError as e:
+                if attempt < SUPABASE_RETRIES:
+                    await asyncio.sleep(0.2 * 2 ** attempt)
+                    continue
+                logger.error(f"HTTP {method} request failed: {e}")
+                raise
+            except httpx.HTTPStatusError as e:
+                logger.error(f"HTTP {method} request failed: {e}")
+                raise
+
+    async def save_website_credentials(self, telegram_id: int, login: str, password: str, subscription_type: str = 'free'):
+        """Сохраняет логин и пароль в Supabase одним upsert-запросом"""
         try:
-            # Сначала проверяем существующую запись
-            existing = self._make_request('GET', 'website_users', {
-                'telegram_id': f'eq.{telegram_id}',
-                'select': 'id'
-            })
-            
             data = {
                 'telegram_id': telegram_id,
                 'login': login,
@@ -59,47 +87,63 @@ class SupabaseHTTPClient:
                 'is_active': True,
                 'subscription_type': subscription_type
             }
-            
-            if existing and len(existing) > 0:
-                # Обновляем существующую запись
-                result = self._make_request('PATCH', f'website_users?telegram_id=eq.{telegram_id}', data)
+            result = await self._make_request(
+                'POST', 'website_users', data,
+                params={'on_conflict': 'telegram_id'},
+                headers={'Prefer': 'resolution=merge-duplicates,return=representation'}
+            )
+            saved = result[0] if result else None
+            if saved:
+                self.credentials_cache.set(telegram_id, saved)
             else:
-                # Создаем новую запись
-                result = self._make_request('POST', 'website_users', data)
-            
-            return result[0] if result else None
-            
+                self.credentials_cache.invalidate(telegram_id)
+            return saved
+
         except Exception as e:
+            self.credentials_cache.invalidate(telegram_id)
             logger.error(f"Error saving credentials to Supabase: {e}")
             raise
-    
-    def get_website_credentials(self, telegram_id: int):
+
+    async def get_website_credentials(self, telegram_id: int):
         """Получает логин и пароль из Supabase"""
+        cached = self.credentials_cache.get(telegram_id, _MISSING)
+        if cached is not _MISSING:
+            return cached
         try:
-            result = self._make_request('GET', 'website_users', {
+            result = await self._make_request('GET', 'website_users', {
                 'telegram_id': f'eq.{telegram_id}',
                 'select': 'login,password,subscription_type,is_active'
             })
-            
-            return result[0] if result else None
-            
+
+            credentials = result[0] if result else None
+            self.credentials_cache.set(telegram_id, credentials)
+            return credentials
+
         except Exception as e:
             logger.error(f"Error getting credentials from Supabase: {e}")
             return None
-    
-    def user_exists(self, telegram_id: int) -> bool:
+
+    async def user_exists(self, telegram_id: int) -> bool:
         """Проверяет, существует ли пользователь в Supabase"""
+        cached = self.credentials_cache.get(telegram_id, _MISSING)
+        if cached is not _MISSING:
+            return cached is not None
         try:
-            result = self._make_request('GET', 'website_users', {
+            result = await self._make_request('GET', 'website_users', {
                 'telegram_id': f'eq.{telegram_id}',
                 'select': 'id'
             })
-            
+
             return len(result) > 0 if result else False
-            
+
         except Exception as e:
             logger.error(f"Error checking user in Supabase: {e}")
             return False
 
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
 # Глобальный клиент Supabase
-supabase = SupabaseHTTPClient()
\ No newline at end of file
+supabase = SupabaseHTTPClient()
@@ -0,0 +1,207 @@
+"""Супервизор: несколько процессов-воркеров бота на одном хосте.
+
+Каждый воркер — обычный bot.py в режиме webhook на локальном порту, со своим
+event loop, пулом соединений с базой и потоками. Супервизор сам получает
+обновления (long polling или публичный webhook) и передаёт каждое воркеру
+по shard_for(user_id), так что сообщения одного пользователя обрабатывает
+один процесс в порядке поступления. Упавший воркер перезапускается,
+по SIGINT/SIGTERM супервизор дожидается доставки принятых обновлений
+и останавливает воркеров штатно.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import secrets
+import aiohttp
+from aiohttp import web
+from telegram import Update
+from telegram.error import TelegramError
+from sharding import SECRET_HEADER, FORWARD_TIMEOUT, update_user_id, shard_for, make_bot, \
+    register_webhook, create_router_app
+
+logger = logging.getLogger(__name__)
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+# Воркеры слушают 127.0.0.1 на портах WORKER_BASE_PORT, WORKER_BASE_PORT + 1, ...
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', '8600'))
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', '30'))
+# Пауза перед перезапуском упавшего воркера растёт до максимума и сбрасывается,
+# если воркер проработал дольше WORKER_STABLE_AFTER секунд
+WORKER_RESTART_DELAY = 1.0
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_STABLE_AFTER = 60.0
+
+
+class WorkerProcess:
+    def __init__(self, index: int, secret_token: str):
+        self.index = index
+        self.port = WORKER_BASE_PORT + index
+        self.secret_token = secret_token
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/telegram'
+
+    def _env(self) -> dict:
+        env = dict(os.environ)
+        env.update({
+            'WEBHOOK_SECRET': self.secret_token,
+            'WEBHOOK_REGISTER': '0',
+            'WEBHOOK_PATH': 'telegram',
+            'WEBHOOK_LISTEN': '127.0.0.1',
+            'PORT': str(self.port),
+            'WEBHOOK_PORT': str(self.port),
+            'BOT_WORKERS': '1'
+        })
+        # У каждого воркера свой эндпоинт /metrics: METRICS_PORT + 1 + номер
+        metrics_port = int(os.getenv('METRICS_PORT', '0'))
+        if metrics_port:
+            env['METRICS_PORT'] = str(metrics_port + 1 + self.index)
+        return env
+
+    async def start(self):
+        # Своя группа процессов: Ctrl+C в терминале получает только супервизор
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_SCRIPT, '--mode', 'webhook', env=self._env(), start_new_session=True
+        )
+        self.started_at = time.monotonic()
+        logger.info(f"Worker {self.index} started, pid {self.process.pid}, port {self.port}")
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), WORKER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Worker {self.index} did not stop in {WORKER_STOP_TIMEOUT}s, killing")
+            self.process.kill()
+            await self.process.wait()
+
+
+class Supervisor:
+    def __init__(self, token: str, workers: int, mode: str = 'polling'):
+        self.token = token
+        self.mode = mode
+        # В режиме polling секрет нужен только между супервизором и воркерами
+        secret_token = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+        self.workers = [WorkerProcess(i, secret_token) for i in range(workers)]
+        self.secret_token = secret_token
+        self._queues = [asyncio.Queue() for _ in self.workers]
+        self._stopping = False
+
+    async def _watch(self, worker: WorkerProcess):
+        """Перезапускает воркера, если он завершился не по команде супервизора"""
+        delay = WORKER_RESTART_DELAY
+        while True:
+            code = await worker.process.wait()
+            if self._stopping:
+                return
+            if time.monotonic() - worker.started_at > WORKER_STABLE_AFTER:
+                delay = WORKER_RESTART_DELAY
+            logger.error(f"Worker {worker.index} exited with code {code}, restarting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            if self._stopping:
+                return
+            delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+            worker.restarts += 1
+            await worker.start()
+
+    async def _forward(self, session, worker: WorkerProcess):
+        """Передаёт обновления шарда воркеру по одному, повторяя, пока воркер не примет"""
+        queue = self._queues[worker.index]
+        headers = {SECRET_HEADER: self.secret_token}
+        while True:
+            data = await queue.get()
+            delay = 0.2
+            while True:
+                try:
+                    async with session.post(worker.url, json=data, headers=headers) as response:
+                        if response.status == 200:
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+                # Воркер ещё запускается или перезапускается
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            queue.task_done()
+
+    async def _poll(self):
+        """Long polling в супервизоре: подтверждённые обновления сразу раскладываются по шардам"""
+        async with make_bot(self.token) as bot:
+            await bot.delete_webhook()
+            offset = None
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+                except TelegramError as e:
+                    logger.error(f"getUpdates failed: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    data = update.to_dict()
+                    self._queues[shard_for(update_user_id(data), len(self.workers))].put_nowait(data)
+
+    async def _serve_webhook(self):
+        """Публичный webhook: обновление подтверждается Telegram после приёма воркером"""
+        url = os.getenv('WEBHOOK_URL')
+        path = os.getenv('WEBHOOK_PATH', 'telegram')
+        listen = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+        port = int(os.getenv('PORT', os.getenv('WEBHOOK_PORT', '8443')))
+        if not url or not os.getenv('WEBHOOK_SECRET'):
+            raise ValueError("Для режима webhook нужны переменные окружения WEBHOOK_URL и WEBHOOK_SECRET")
+        await register_webhook(self.token, url, path, self.secret_token)
+        app = create_router_app([w.url for w in self.workers], self.secret_token, path)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        logger.info(f"Supervisor webhook listening on {listen}:{port}/{path}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def run(self):
+        for worker in self.workers:
+            await worker.start()
+        watchers = [asyncio.create_task(self._watch(worker)) for worker in self.workers]
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT)) as session:
+            forwarders = [asyncio.create_task(self._forward(session, worker)) for worker in self.workers]
+            source = asyncio.create_task(self._poll() if self.mode == 'polling' else self._serve_webhook())
+            stopped = asyncio.create_task(stop.wait())
+            await asyncio.wait([source, stopped], return_when=asyncio.FIRST_COMPLETED)
+
+            # Новые обновления больше не принимаем; уже полученные доставляем воркерам
+            source.cancel()
+            await asyncio.gather(source, return_exceptions=True)
+            try:
+                await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), WORKER_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"{sum(q.qsize() for q in self._queues)} updates were not delivered on shutdown")
+            for task in forwarders:
+                task.cancel()
+
+        self._stopping = True
+        for task in watchers:
+            task.cancel()
+        await asyncio.gather(*watchers, return_exceptions=True)
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        if source.done() and not source.cancelled() and source.exception():
+            raise source.exception()
+
+
+def run_supervisor(token: str, workers: int, mode: str = 'polling'):
+    asyncio.run(Supervisor(token, workers, mode).run())
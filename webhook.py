@@ -0,0 +1,90 @@
+import os
+import hmac
+import signal
+import asyncio
+import logging
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_webhook_app(application: Application, secret_token: str, path: str = 'telegram') -> web.Application:
+    """aiohttp-приложение, принимающее обновления Telegram в очередь Application.
+
+    Запрос подтверждается сразу после постановки в очередь, обработкой
+    занимаются воркеры Application (concurrent_updates).
+    """
+    async def handle_update(request: web.Request) -> web.Response:
+        received = request.headers.get(SECRET_HEADER, '')
+        if not secret_token or not hmac.compare_digest(received, secret_token):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        update = Update.de_json(data, application.bot)
+        if update is not None:
+            await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({'ok': True, 'queue': application.update_queue.qsize()})
+
+    app = web.Application()
+    app.router.add_post(f'/{path}', handle_update)
+    app.router.add_get('/healthz', health)
+    return app
+
+
+async def run_webhook(application: Application):
+    """Запускает бота в режиме webhook до получения SIGINT/SIGTERM.
+
+    Настройки читаются из окружения при запуске, когда .env уже загружен.
+    """
+    url = os.getenv('WEBHOOK_URL')  # публичный адрес, например https://bot.example.com
+    secret_token = os.getenv('WEBHOOK_SECRET')
+    path = os.getenv('WEBHOOK_PATH', 'telegram')
+    listen = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    port = int(os.getenv('PORT', os.getenv('WEBHOOK_PORT', '8443')))
+    # Воркер за маршрутизатором (sharding.py) webhook в Telegram не регистрирует
+    register = os.getenv('WEBHOOK_REGISTER', '1') == '1'
+    if not secret_token:
+        raise ValueError("Для режима webhook нужна переменная окружения WEBHOOK_SECRET")
+    if register and not url:
+        raise ValueError("Для режима webhook нужна переменная окружения WEBHOOK_URL")
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if register:
+        await application.bot.set_webhook(
+            url=f"{url.rstrip('/')}/{path}",
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=100
+        )
+    await application.start()
+
+    runner = web.AppRunner(create_webhook_app(application, secret_token, path), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    logger.info(f"Webhook server listening on {listen}:{port}/{path}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)